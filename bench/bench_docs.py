@@ -0,0 +1,54 @@
+"""Compare indexing the registers of functions for their documentation with the old substring search.
+
+The substring search looked for each register in the text of the function, so it also matched ``$t1`` in
+``$t10`` and registers in comments. The index only counts the registers of instructions.
+
+    $ python3 bench/bench_docs.py [size]
+"""
+import sys
+from pathlib import Path
+from timeit import repeat
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mppd  # noqa: E402
+from generate import generate, parse_size  # noqa: E402
+
+REGISTERS = sorted(mppd.SAVED_REGISTERS | mppd.TEMPORARY_REGISTERS | mppd.ARGUMENT_REGISTERS | mppd.FRAME_REGISTERS)
+
+
+def search_each(text, identifiers):
+    registers = set(identifiers.values())
+    return [x for x in REGISTERS if x in registers or x in text]
+
+
+def main():
+    size = parse_size(sys.argv[1]) if len(sys.argv) > 1 else 2 ** 21
+    source, names = generate(size)
+    lines = list(mppd.tokenize(source.split('\n')))
+    preprocessor = mppd.Preprocessor(mppd.Options(extra_functions=names))
+    preprocessor.preprocess_lines(lines)
+
+    index = mppd.LabelIndex(lines, names)
+    starts = [index[name].line for name in names] + [len(lines)]
+    functions = [(lines[start:end], preprocessor.identifiers[name])
+                 for name, start, end in zip(names, starts, starts[1:])]
+    texts = [('\n'.join(line.text for line in f_lines), identifiers) for f_lines, identifiers in functions]
+
+    def search():
+        return [search_each(text, identifiers) for text, identifiers in texts]
+
+    def build():
+        return [mppd.RegisterIndex.build(f_lines, identifiers) for f_lines, identifiers in functions]
+
+    runs = 5
+    searched = min(repeat(search, number=1, repeat=runs))
+    built = min(repeat(build, number=1, repeat=runs))
+    print('{} functions, {} lines'.format(len(functions), len(lines)))
+    print('substring search per register: {:8.2f} ms'.format(searched * 1000))
+    print('register index:                {:8.2f} ms'.format(built * 1000))
+
+
+if __name__ == '__main__':
+    main()
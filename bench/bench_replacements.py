@@ -0,0 +1,52 @@
+"""Compare the single-pass identifier substitution over lexed lines with the old per-identifier str.replace loop.
+
+    $ python3 bench/bench_replacements.py [placeholders] [lines]
+"""
+import sys
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mppd  # noqa: E402
+
+
+def make_function(placeholders, lines):
+    out = ['func:']
+    for i in range(lines):
+        a, b, c = (i % placeholders, (i * 7) % placeholders, (i * 13) % placeholders)
+        out.append('    add     %v{}, %v{}, %v{}'.format(a, b, c))
+    return '\n'.join(out) + '\n'
+
+
+def replace_each(text, identifiers):
+    for i, r in sorted(identifiers.items(), key=lambda k: len(k[0]), reverse=True):
+        text = text.replace(i, r)
+    return text
+
+
+def main():
+    placeholders = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    text = make_function(placeholders, lines)
+    identifiers = {'%v{}'.format(i): '$r{}'.format(i) for i in range(placeholders)}
+
+    tokens = list(mppd.tokenize(text.split('\n')))
+    replace_identifiers = mppd.MipsProcessor.replace_identifiers
+
+    def replace_lines():
+        return '\n'.join(replace_identifiers(line, identifiers) for line in tokens)
+
+    expected = replace_each(text, identifiers)
+    assert replace_lines() == expected
+
+    runs = 5
+    old = timeit(lambda: replace_each(text, identifiers), number=runs) / runs
+    lexed = timeit(replace_lines, number=runs) / runs
+    print('{} placeholders, {} lines'.format(placeholders, lines))
+    print('str.replace per identifier: {:8.2f} ms'.format(old * 1000))
+    print('single pass over lines:     {:8.2f} ms'.format(lexed * 1000))
+
+
+if __name__ == '__main__':
+    main()
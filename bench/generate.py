@@ -0,0 +1,103 @@
+"""Generate synthetic MIPS assembly for benchmarks.
+
+Functions have a prologue and epilogue, loops between labels, and a mix of arithmetic, memory and
+branch instructions on placeholders, written with irregular spacing for the prettifier to fix.
+
+    $ python3 bench/generate.py 1M > input.s
+"""
+import argparse
+import random
+
+MNEMONIC_TEMPLATES = (
+    ('add', '{d}, {a}, {b}'),
+    ('addi', '{d}, {a}, {n}'),
+    ('sub', '{d}, {a}, {b}'),
+    ('mul', '{d}, {a}, {b}'),
+    ('and', '{d}, {a}, {b}'),
+    ('slt', '{d}, {a}, {b}'),
+    ('sll', '{d}, {a}, 2'),
+    ('move', '{d}, {a}'),
+    ('li', '{d}, {n}'),
+    ('lw', '{d}, {o}($sp)'),
+    ('sw', '{a}, {o}($sp)'),
+    ('lw', '{d}, 0({a})'),
+)
+COMMENTS = ('# i++', '# load the next element', '# swap', '# x = y + z', '# TODO check bounds', '# %v0 is the count')
+SEPARATORS = (' ', '  ', '\t', ' \t')
+COMMAS = (', ', ',', ' , ')
+
+
+def parse_size(text):
+    """Parse a size in bytes, with an optional K or M suffix."""
+    units = {'K': 2 ** 10, 'M': 2 ** 20}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def generate(size, function_lines=200, labels=8, placeholders=12, comments=0.3, seed=0):
+    """Return the source of at least ``size`` bytes, and the names of its functions."""
+    rng = random.Random(seed)
+    out = []
+    names = []
+    length = 0
+
+    def emit(label, mnemonic, operands):
+        separator = rng.choice(SEPARATORS)
+        text = '{}{}{}{}'.format(label + ':' if label else '', '    ' if rng.random() < 0.8 else '\t',
+                                 mnemonic + separator, operands)
+        if rng.random() < comments:
+            text += rng.choice(SEPARATORS) + rng.choice(COMMENTS)
+        out.append(text)
+        return len(text) + 1
+
+    def operand(variables):
+        return rng.choice(variables)
+
+    while length < size:
+        name = 'main' if not names else 'func{}'.format(len(names))
+        names.append(name)
+        variables = ['%v{}'.format(i) for i in range(placeholders)]
+
+        out.append('')
+        length += emit(name, 'addi', '$sp, $sp, -8') + 1
+        length += emit(None, 'sw', '$ra, 0($sp)')
+        # The first value has to survive calls
+        length += emit(None, 'li', variables[0] + '.s, 0')
+
+        per_label = max(function_lines // max(labels, 1), 4)
+        for label in range(labels):
+            loop = '{}_loop{}'.format(name, label)
+            for line in range(per_label):
+                mnemonic, template = rng.choice(MNEMONIC_TEMPLATES)
+                comma = rng.choice(COMMAS)
+                operands = template.format(d=operand(variables), a=operand(variables), b=operand(variables),
+                                           n=rng.randrange(-64, 256), o=4 * rng.randrange(2)).replace(', ', comma)
+                length += emit(loop if not line else None, mnemonic, operands)
+            length += emit(None, 'blt', '{}, {}, {}'.format(operand(variables), operand(variables), loop))
+            if names[1:] and rng.random() < 0.5:
+                length += emit(None, 'jal', rng.choice(names[1:]))
+
+        length += emit(None, 'lw', '$ra, 0($sp)')
+        length += emit(None, 'addi', '$sp, $sp, 8')
+        length += emit(None, 'jr', '$ra')
+
+    return '\n'.join(out) + '\n', names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('size', type=parse_size, help='Minimum size in bytes, such as 64K or 10M')
+    parser.add_argument('--function-lines', type=int, default=200, help='Instructions per function')
+    parser.add_argument('--labels', type=int, default=8, help='Labels per function')
+    parser.add_argument('--placeholders', type=int, default=12, help='Placeholders per function')
+    parser.add_argument('--comments', type=float, default=0.3, help='Fraction of lines with a comment')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    source, _ = generate(args.size, args.function_lines, args.labels, args.placeholders, args.comments, args.seed)
+    print(source, end='')
+
+
+if __name__ == '__main__':
+    main()
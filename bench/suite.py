@@ -0,0 +1,145 @@
+"""Time each stage of mppd on synthetic sources of increasing size, and their peak memory.
+
+Results can be written as JSON and compared with those of another version.
+
+    $ python3 bench/suite.py --sizes 16K,1M,16M --json after.json --compare before.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from io import StringIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mppd  # noqa: E402
+from generate import generate, parse_size  # noqa: E402
+
+STAGES = ('prettify', 'tokenize', 'create_identifiers_mapping', 'perform_replacements', 'docs',
+          'fix_comment_spacing')
+
+
+def split_functions(lines, function_names):
+    """Return the lines of each function, as :meth:`mppd.Preprocessor.preprocess_lines` splits them."""
+    index = mppd.LabelIndex(lines, function_names)
+    starts = [index[name].line for name in function_names] + [len(lines)]
+    return {name: lines[start:end] for name, start, end in zip(function_names, starts, starts[1:])}
+
+
+def run_stages(source, function_names):
+    """Run each stage on its own, on the output of the previous ones, returning their times in seconds."""
+    options = mppd.Options(extra_functions=function_names, docs=True, locals=True, structure=True)
+    preprocessor = mppd.Preprocessor(options)
+    times = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        times[stage] = times.get(stage, 0) + time.perf_counter() - start
+        return result
+
+    pretty = timed('prettify', lambda: list(preprocessor.prettify_lines(StringIO(source))))
+    lines = timed('tokenize', lambda: list(mppd.tokenize(pretty)))
+
+    output = []
+    for name, f_lines in split_functions(lines, function_names).items():
+        identifiers, _ = timed('create_identifiers_mapping', preprocessor.create_identifiers_mapping, f_lines)
+        output.extend(timed('perform_replacements',
+                            lambda: [preprocessor.replace_identifiers(line, identifiers) for line in f_lines]))
+        timed('docs', lambda: mppd.RegisterIndex.build(f_lines, identifiers))
+    timed('docs', mppd.LabelIndex, lines, function_names)
+
+    timed('fix_comment_spacing', preprocessor.fix_comment_spacing, mppd.tokenize(output))
+    return times
+
+
+def run_total(source, function_names):
+    options = mppd.Options(prettify=True, extra_functions=function_names, docs=True, locals=True, structure=True)
+    start = time.perf_counter()
+    mppd.preprocess_text(source, options)
+    return time.perf_counter() - start
+
+
+def measure(size, repeat=3, **generator_options):
+    source, function_names = generate(size, **generator_options)
+    lines = source.count('\n')
+
+    # Best of several runs, which is the least disturbed by other processes
+    runs = [run_stages(source, function_names) for _ in range(repeat)]
+    stages = {stage: min(run[stage] for run in runs) for stage in STAGES}
+    total = min(run_total(source, function_names) for _ in range(repeat))
+
+    # Measured separately, since tracing allocations slows everything down
+    tracemalloc.start()
+    run_total(source, function_names)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'size': size,
+        'bytes': len(source),
+        'lines': lines,
+        'functions': len(function_names),
+        'stages': stages,
+        'total': total,
+        'lines_per_second': lines / total,
+        'peak_memory': peak,
+    }
+
+
+def print_result(result, baseline=None):
+    print('{bytes} bytes, {lines} lines, {functions} functions'.format(**result))
+    rows = list(result['stages'].items()) + [('total', result['total'])]
+    for stage, seconds in rows:
+        row = '  {:<28} {:10.1f} ms {:10.2f} MiB/s'.format(stage, seconds * 1000, result['bytes'] / seconds / 2 ** 20)
+        if baseline is not None:
+            before = baseline['total'] if stage == 'total' else baseline['stages'].get(stage)
+            if before:
+                row += ' {:8.2f}x'.format(before / seconds)
+        print(row)
+    print('  {:<28} {:10.0f} lines/s'.format('throughput', result['lines_per_second']))
+    print('  {:<28} {:10.1f} MiB'.format('peak memory', result['peak_memory'] / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='16K,256K,4M',
+                        help='Comma separated source sizes, such as 16K,1M,32M')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each size, the fastest is kept')
+    parser.add_argument('--function-lines', type=int, default=200)
+    parser.add_argument('--labels', type=int, default=8)
+    parser.add_argument('--placeholders', type=int, default=12)
+    parser.add_argument('--comments', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE', help='Write the results to a JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='Show the speedup over results from a JSON file')
+    args = parser.parse_args()
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = {x['size']: x for x in json.load(f)['results']}
+
+    results = []
+    for size in (parse_size(x) for x in args.sizes.split(',')):
+        result = measure(size, args.repeat, function_lines=args.function_lines, labels=args.labels,
+                         placeholders=args.placeholders, comments=args.comments, seed=args.seed)
+        print_result(result, baselines.get(size))
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'version': mppd.__version__,
+                'python': platform.python_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,23 @@
 import argparse
+import cProfile
+import hashlib
+import json
+import mmap
+import os
 import re
 import operator
-from shutil import copy2
+import sys
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from difflib import SequenceMatcher, unified_diff
+from glob import glob, has_magic
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import chain, groupby, repeat
+from shutil import copymode, copystat
 from sys import stderr
+from tempfile import mkstemp
 from textwrap import dedent
 
 __version__ = '1.2.0'
@@ -13,8 +28,52 @@ IDENTIFIER_REGEX = r"%\w+"
 IDENTIFIER_ARG_REGEX = r"%\w+(\.\w+)?"
 LABELS_REGEX = r"^\w*:"
 
+IDENTIFIER_ARG_PATTERN = re.compile(IDENTIFIER_ARG_REGEX)
+# Registers and identifiers, which stand in for registers
+OPERAND_REGISTER_PATTERN = re.compile(r"\$\w+|%\w+")
+# Registers and identifiers, and the commas separating the operands they are in
+OPERAND_TOKEN_PATTERN = re.compile(r"\$\w+|%\w+|,")
+LABELS_PATTERN = re.compile(LABELS_REGEX)
+# Labels, and the last operand of calls, in the text of a whole file
+DEFINED_LABEL_PATTERN = re.compile(r"^(\w*):", re.MULTILINE)
+CALL_OPERANDS_PATTERN = re.compile(r"^(?:\w*:)?[^\S\n]*(?:jal|jalr|bal|bgezal|bltzal)[^\S\n]+([^#\n]*)", re.MULTILINE)
+
+STORE_MNEMONICS = frozenset(('sb', 'sh', 'sw', 'swl', 'swr', 'sd', 'ush', 'usw', 's.s', 's.d', 'swc1', 'sdc1'))
+JUMP_MNEMONICS = frozenset(('j', 'jr', 'jal', 'jalr'))
+HI_LO_MNEMONICS = frozenset(('mult', 'multu', 'madd', 'maddu', 'msub', 'msubu', 'mthi', 'mtlo'))
+# Instructions which write to $ra
+LINK_MNEMONICS = frozenset(('jal', 'jalr', 'bal', 'bgezal', 'bltzal'))
+LOAD_MNEMONICS = frozenset(('lb', 'lbu', 'lh', 'lhu', 'lw', 'lwl', 'lwr', 'll', 'ld', 'ulh', 'ulhu', 'ulw',
+                            'l.s', 'l.d', 'lwc1', 'ldc1'))
+# Instructions which write to their first operand, everything else only reads its registers
+WRITE_MNEMONICS = LOAD_MNEMONICS | frozenset((
+    'add', 'addu', 'addi', 'addiu', 'sub', 'subu', 'subi', 'subiu', 'and', 'andi', 'or', 'ori', 'xor', 'xori',
+    'nor', 'not', 'neg', 'negu', 'abs', 'slt', 'sltu', 'slti', 'sltiu', 'seq', 'sne', 'sge', 'sgeu', 'sgt', 'sgtu',
+    'sle', 'sleu', 'sll', 'srl', 'sra', 'sllv', 'srlv', 'srav', 'rol', 'ror', 'rotr', 'rotrv', 'clo', 'clz',
+    'seb', 'seh', 'wsbh', 'ext', 'ins', 'movn', 'movz', 'movf', 'movt', 'mul', 'mulu', 'mulo', 'mulou', 'rem',
+    'remu', 'li', 'la', 'lui', 'move', 'mfhi', 'mflo', 'mfc0', 'mfc1', 'cfc1'))
+# Floating point operations, such as add.s and cvt.w.d, which write to their first operand
+FLOAT_WRITE_OPERATIONS = frozenset(('add', 'sub', 'mul', 'div', 'abs', 'neg', 'mov', 'movn', 'movz', 'movf', 'movt',
+                                    'sqrt', 'cvt', 'round', 'trunc', 'floor', 'ceil'))
+MULT_DIV_MNEMONICS = HI_LO_MNEMONICS | frozenset(('div', 'divu', 'mul', 'mulo', 'mulou', 'rem', 'remu'))
+SYSCALL_MNEMONICS = frozenset(('syscall', 'break'))
+
+# Classes of instructions for --cost, and a rough number of cycles each instruction of the class takes
+CYCLES = OrderedDict((('alu', 1), ('load/store', 2), ('branch', 2), ('mult/div', 10), ('syscall', 50)))
+# Times the code of a loop is assumed to run for each time the code around it does
+LOOP_WEIGHT = 10
+
+TEMPORARY_REGISTERS = frozenset("$t{}".format(i) for i in range(10))
+ARGUMENT_REGISTERS = frozenset("$a{}".format(i) for i in range(10))
+SAVED_REGISTERS = frozenset("$s{}".format(i) for i in range(10))
+FRAME_REGISTERS = frozenset(('$fp', '$ra', '$sp'))
+
 NUM_TABS_AFTER_INSTRUCTION = 2
 NUM_TABS_BEFORE_COMMENT = 8
+# Columns of spaced output, widened for blocks with longer lines
+INDENT = ' ' * 4
+MNEMONIC_WIDTH = 10
+COMMENT_COLUMN = 52
 
 CEND = '\33[0m'
 CBLACK = '\33[30m'
@@ -27,394 +86,2281 @@ CBEIGE = '\33[36m'
 CGREY = '\33[90m'
 
 LOG_PRETTIFY_PREFIX = CBLUE + '[PRETTIFY]' + CEND
+# Tab separated fields, without surrounding whitespace
+TAB_FIELD_PATTERN = re.compile(r"[^\t\s](?:[^\t]*[^\t\s])?")
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+LOG_FILE_PREFIX = CBLUE + '[FILE]' + CEND
+
+# Levels of diagnostics, as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+
+
+# Whether to write colors to a file, for a --color of auto, always or never
+def use_color(color, file):
+    if color == 'auto':
+        return 'NO_COLOR' not in os.environ and (file or sys.stdout).isatty()
+    return color == 'always'
+
+
+def diagnostic_json(level, path, message):
+    return json.dumps({'level': LEVEL_NAMES[level], 'file': path, 'message': ANSI_PATTERN.sub('', message)})
+
+
+def log_error(err, color='auto'):
+    message = CRED + 'error:' + CEND + ' ' + err
+    print(message if use_color(color, stderr) else ANSI_PATTERN.sub('', message), file=stderr)
+
+
+# A line of source split into its parts, with the %identifiers of its code found when first read
+class Line(namedtuple('Line', 'num text label code comment mnemonic operands')):
+    @property
+    def is_indented(self):
+        # Line starts with a tab or four spaces
+        text = self.text.rstrip()
+        return bool(text) and (text[0] == '\t' or (len(text) > 4 and text[:3].isspace()))
+
+    @property
+    def identifiers(self):
+        cached = self.__dict__
+        if 'identifiers' not in cached:
+            identifiers = ()
+            if '%' in self.code:
+                identifiers = tuple(identifier_span(m) for m in IDENTIFIER_ARG_PATTERN.finditer(self.code))
+            cached['identifiers'] = identifiers
+        return cached['identifiers']
+
+
+def identifier_span(match):
+    flag = match.group(1)
+    if flag:
+        return match.start(), match.end(), match.group()[:-len(flag)], flag[1:]
+    return match.start(), match.end(), match.group(), None
+
+
+def tokenize_line(text, num=0):
+    code, has_comment, comment = text.partition('#')
+    if not has_comment:
+        comment = None
+
+    label = None
+    label_match = LABELS_PATTERN.match(code) if ':' in code else None
+    if label_match:
+        label = label_match.group()[:-1]
+        parts = code[label_match.end():].split()
+    else:
+        parts = code.split()
+
+    return Line(num, text, label, code, comment, parts[0] if parts else None, tuple(parts[1:]))
+
+
+# Lex source lines, with or without trailing newlines
+def tokenize(lines, start=1):
+    for num, text in enumerate(lines, start=start):
+        yield tokenize_line(text.rstrip('\n'), num)
+
+
+# Lay out (code, mnemonic, operands, comment) rows of spaced output in columns
+def align_block(rows):
+    width = MNEMONIC_WIDTH
+    for _, mnemonic, _, _ in rows:
+        if mnemonic is not None and len(mnemonic) >= width:
+            width = len(mnemonic) + 1
+
+    codes = []
+    column = COMMENT_COLUMN
+    for code, mnemonic, operands, comment in rows:
+        if operands:
+            code = INDENT + mnemonic.ljust(width) + operands
+        elif mnemonic is not None:
+            code = INDENT + mnemonic
+        if comment is not None and len(code) >= column:
+            column = len(code) + 1
+        codes.append(code)
+
+    return [code if row[3] is None else code.ljust(column) + '# ' + row[3] for code, row in zip(codes, rows)]
+
+
+# Lay out rows one block between blank lines at a time
+def aligned_blocks(rows):
+    block = []
+    for row in rows:
+        if not row[0] and row[1] is None and row[3] is None:
+            yield align_block(block)
+            block = []
+            yield [row[0]]
+        else:
+            block.append(row)
+    yield align_block(block)
+
+
+def writes_first_operand(mnemonic, operand_count):
+    # Division into hi and lo, unless given a destination
+    if mnemonic in ('div', 'divu'):
+        return operand_count == 3
+    if mnemonic in WRITE_MNEMONICS:
+        return operand_count > 0
+    return '.' in mnemonic and mnemonic.partition('.')[0] in FLOAT_WRITE_OPERATIONS and operand_count > 0
+
+
+# Registers and identifiers written and read by an instruction, in order of appearance
+def line_registers(line):
+    mnemonic = line.mnemonic
+    if mnemonic is None or mnemonic[0] == '.':
+        return [], []
+
+    defs = ['$ra'] if mnemonic in LINK_MNEMONICS else []
+    operands = line.operands
+    if not operands:
+        return defs, []
+
+    # One pass over the operands as lexed, counting commas rather than splitting on them
+    tokens = OPERAND_TOKEN_PATTERN.findall(operands[0] if len(operands) == 1 else ' '.join(operands))
+    commas = tokens.count(',')
+    if not commas:
+        uses = tokens
+    else:
+        uses = [x for x in tokens if x != ',']
+    # Registers in the first operand are written, unless used as an address
+    if tokens and tokens[0] != ',' and (not commas or tokens[1] == ',') and writes_first_operand(mnemonic, commas + 1):
+        defs.append(uses.pop(0))
+    return defs, uses
+
+
+# Line numbers of the registers written and read by some lines, identifiers counting as their registers
+class RegisterIndex(namedtuple('RegisterIndex', 'defs uses')):
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, lines, identifiers=None):
+        identifiers = identifiers or {}
+        defs = {}
+        uses = {}
+        for line in lines:
+            if line.mnemonic is None:
+                continue
+            written, read = line_registers(line)
+            for registers, index in ((written, defs), (read, uses)):
+                for register in registers:
+                    if register[0] != '$':
+                        register = identifiers.get(register, register)
+                        if register[0] != '$':
+                            continue
+                    if register in index:
+                        index[register].append(line.num)
+                    else:
+                        index[register] = [line.num]
+        return cls(defs, uses)
 
+    @property
+    def referenced(self):
+        return self.defs.keys() | self.uses.keys()
 
-def log_error(err):
-    print(CRED + 'error:' + CEND + ' ' + err, file=stderr)
 
+# Label an instruction may jump to, and whether it may continue to the next line
+def control_flow(line):
+    mnemonic = line.mnemonic
+    if mnemonic is None or mnemonic[0] == '.' or mnemonic in LINK_MNEMONICS:
+        return None, True
+    if mnemonic == 'jr':
+        return None, False
+    if mnemonic == 'j' or (mnemonic[0] == 'b' and mnemonic != 'break'):
+        target = ' '.join(line.operands).split(',')[-1].strip() if line.operands else None
+        return target, mnemonic not in ('j', 'b')
+    return None, True
 
-class MipsProcessor:
 
-    def __init__(self, args):
-        self.__args = args
+# Jumps to an address in a register, as with jump tables, rather than returning
+def indirect_jump(line):
+    return line.mnemonic == 'jr' and bool(line.operands) and line.operands[0].rstrip(',') not in ('$ra', '$31')
+
+
+Label = namedtuple('Label', 'name line function successors')
+
+
+# Position, owning function and successors of each label of a file, and the labels of each function
+class LabelIndex:
+    def __init__(self, lines, function_names=()):
+        function_names = list(function_names)
+        self.labels = OrderedDict()
+        self.functions = OrderedDict((name, []) for name in function_names)
+
+        functions_found = 0
+        current_function = None
+        current = None
+        falls_through = True
+        for position, line in enumerate(lines):
+            if line.label is not None:
+                if functions_found < len(function_names) and line.label == function_names[functions_found]:
+                    current_function = function_names[functions_found]
+                    functions_found += 1
+                if current is not None and falls_through:
+                    current.successors.append(line.label)
+                current = Label(line.label, position, current_function, [])
+                self.labels[line.label] = current
+                if current_function is not None:
+                    self.functions[current_function].append(line.label)
+                falls_through = True
+
+            if line.mnemonic is not None:
+                target, falls_through = control_flow(line)
+                if current is not None and target is not None and target not in current.successors:
+                    current.successors.append(target)
+
+        # Jumps outside of the file are not followed
+        for name, label in self.labels.items():
+            self.labels[name] = label._replace(
+                successors=tuple(x for x in label.successors if x in self.labels))
+
+    def __getitem__(self, name):
+        return self.labels[name]
+
+    def __contains__(self, name):
+        return name in self.labels
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+
+# Label an instruction calls, if any, calls through registers having none
+def call_target(line):
+    if line.mnemonic not in LINK_MNEMONICS or not line.operands:
+        return None
+    target = ' '.join(line.operands).split(',')[-1].strip()
+    if not target or OPERAND_REGISTER_PATTERN.match(target):
+        return None
+    return target
+
+
+FunctionSummary = namedtuple('FunctionSummary', 'uses clobbers saved')
+
+
+# Functions of a file, the functions each calls, and the labels each calls outside the file
+class CallGraph:
+    def __init__(self, lines, function_names=()):
+        lines = list(lines)
+        labels = {line.label for line in lines if line.label is not None}
+        called = {call_target(line) for line in lines if line.mnemonic in LINK_MNEMONICS}
+        function_names = (set(function_names) | called) & labels
+
+        self.calls = OrderedDict()
+        self.external = {}
+        current = None
+        for line in lines:
+            if line.label in function_names:
+                current = line.label
+                self.calls.setdefault(current, [])
+            target = call_target(line) if line.mnemonic in LINK_MNEMONICS else None
+            if current is None or target is None:
+                continue
+            callees = self.calls[current] if target in labels else self.external.setdefault(current, [])
+            if target not in callees:
+                callees.append(target)
+
+    @property
+    def functions(self):
+        return list(self.calls)
+
+    # Strongly connected components, each after the components it calls
+    def components(self):
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        result = []
+        for root in self.calls:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.calls[root]))]
+            while work:
+                name, callees = work[-1]
+                for callee in callees:
+                    if callee not in index:
+                        index[callee] = low[callee] = len(index)
+                        stack.append(callee)
+                        on_stack.add(callee)
+                        work.append((callee, iter(self.calls[callee])))
+                        break
+                    if callee in on_stack:
+                        low[name] = min(low[name], index[callee])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        low[caller] = min(low[caller], low[name])
+                    if low[name] == index[name]:
+                        component = []
+                        while not component or component[-1] != name:
+                            component.append(stack.pop())
+                            on_stack.discard(component[-1])
+                        result.append(component)
+        return result
+
+    # Combine the values of each function with those of every function it calls, transitively
+    def compose(self, values):
+        result = {}
+        for component in self.components():
+            members = set(component)
+            total = set()
+            for name in component:
+                total.update(values.get(name, ()))
+                total.update(*(result[x] for x in self.calls[name] if x not in members))
+            total = frozenset(total)
+            for name in component:
+                result[name] = total
+        return result
+
+
+Block = namedtuple('Block', 'name lines successors')
+
+
+# Basic blocks of some lines by name, named after their label or the last label and a counter
+def basic_blocks(lines):
+    names = []
+    block_lines = {}
+    targets = {}
+    falls_through = {}
+    indirect = set()
+
+    label = None
+    counts = {}
+    ended = False
+    for line in lines:
+        name = None
+        if line.label is not None:
+            label = line.label
+            if label not in counts:
+                counts[label] = 0
+                name = label
+            else:
+                # Repeated labels, such as numeric local labels, carry on counting from the last block
+                counts[label] += 1
+                name = '{}.{}'.format(label, counts[label])
+        elif not names or (ended and line.mnemonic is not None):
+            if label is not None:
+                counts[label] += 1
+                name = '{}.{}'.format(label, counts[label])
+            else:
+                name = str(line.num)
+
+        if name is not None:
+            names.append(name)
+            block_lines[name] = []
+            targets[name] = []
+            falls_through[name] = True
+            ended = False
+
+        current = names[-1]
+        block_lines[current].append(line)
+        if line.mnemonic is not None:
+            target, falls_through[current] = control_flow(line)
+            if target is not None:
+                targets[current].append(target)
+            elif indirect_jump(line):
+                indirect.add(current)
+            ended = target is not None or not falls_through[current]
+
+    labels = [name for name in names if block_lines[name][0].label is not None]
+    blocks = OrderedDict()
+    for i, name in enumerate(names):
+        successors = [x for x in targets[name] if x in block_lines]
+        if name in indirect:
+            successors.extend(x for x in labels if x not in successors)
+        if falls_through[name] and i + 1 < len(names) and names[i + 1] not in successors:
+            successors.append(names[i + 1])
+        blocks[name] = Block(name, block_lines[name], tuple(successors))
+    return blocks
+
+
+# Identifiers among names live at the same time as each of them
+def interference_graph(lines, names):
+    names = set(names)
+    blocks = basic_blocks(lines)
+
+    # The identifiers written and read by each instruction, and read before being written in each block
+    accesses = {}
+    gen = {}
+    kill = {}
+    for name, block in blocks.items():
+        accesses[name] = []
+        gen[name] = set()
+        kill[name] = set()
+        for line in block.lines:
+            defs, uses = line_registers(line)
+            defs = {x for x in defs if x in names}
+            uses = {x for x in uses if x in names}
+            accesses[name].append((defs, uses))
+            gen[name].update(uses - kill[name])
+            kill[name].update(defs)
+
+    live_in = {name: set() for name in blocks}
+    live_out = {name: set() for name in blocks}
+    changed = True
+    while changed:
+        changed = False
+        for name in reversed(blocks):
+            live_out[name] = set().union(*(live_in[x] for x in blocks[name].successors))
+            block_in = gen[name] | (live_out[name] - kill[name])
+            if block_in != live_in[name]:
+                live_in[name] = block_in
+                changed = True
+
+    graph = {name: set() for name in names}
+
+    def interfere(name, live):
+        for other in live:
+            if other != name:
+                graph[name].add(other)
+                graph[other].add(name)
+
+    # Identifiers read before being written are live together on entry
+    if blocks:
+        entry = live_in[next(iter(blocks))]
+        for name in entry:
+            interfere(name, entry)
+
+    for name in blocks:
+        live = set(live_out[name])
+        for defs, uses in reversed(accesses[name]):
+            for written in defs:
+                interfere(written, live)
+            live -= defs
+            live |= uses
+    return graph
+
+
+# Blocks of each loop by its header, loops being found from their back edges
+def find_loops(blocks):
+    names = list(blocks)
+    position = {name: i for i, name in enumerate(names)}
+
+    # The last block jumping back to each loop header
+    ends = {}
+    for name, block in blocks.items():
+        for successor in block.successors:
+            if position[successor] <= position[name]:
+                ends[successor] = max(ends.get(successor, 0), position[name])
+
+    return OrderedDict((header, names[position[header]:ends[header] + 1])
+                       for header in sorted(ends, key=position.get))
+
+
+# Number of loops around each basic block
+def loop_depths(blocks):
+    depths = dict.fromkeys(blocks, 0)
+    for members in find_loops(blocks).values():
+        for name in members:
+            depths[name] += 1
+    return depths
+
+
+# Bytes an instruction pushes onto the stack, negative when popping
+def stack_adjustment(line):
+    if line.mnemonic not in ('addi', 'addiu', 'add', 'addu', 'sub', 'subu'):
+        return 0
+    operands = [x.strip() for x in ' '.join(line.operands).split(',')]
+    if len(operands) != 3 or operands[0] != '$sp' or operands[1] != '$sp':
+        return 0
+    try:
+        size = int(operands[2], 0)
+    except ValueError:
+        return 0
+    return size if line.mnemonic.startswith('sub') else -size
+
+
+# Uses of each identifier, weighted by LOOP_WEIGHT to the power of their loop depth
+def spill_costs(lines):
+    blocks = basic_blocks(lines)
+    depths = loop_depths(blocks)
+    costs = {}
+    for name, block in blocks.items():
+        weight = LOOP_WEIGHT ** depths[name]
+        for line in block.lines:
+            for _, _, identifier, _ in line.identifiers:
+                costs[identifier] = costs.get(identifier, 0) + weight
+    return costs
+
+
+# Class of an instruction in CYCLES
+def instruction_class(mnemonic):
+    if mnemonic in LOAD_MNEMONICS or mnemonic in STORE_MNEMONICS:
+        return 'load/store'
+    if mnemonic in MULT_DIV_MNEMONICS:
+        return 'mult/div'
+    if mnemonic in SYSCALL_MNEMONICS:
+        return 'syscall'
+    if mnemonic in JUMP_MNEMONICS or mnemonic[0] == 'b':
+        return 'branch'
+    return 'alu'
+
+
+Cost = namedtuple('Cost', 'classes instructions cycles loops')
+
+
+# Instructions of a function by class and the cycles they take, weighted by loop depth
+def static_cost(lines):
+    blocks = basic_blocks(lines)
+    depths = loop_depths(blocks)
+    classes = OrderedDict.fromkeys(CYCLES, 0)
+    counts = {}
+    cycles = 0
+    for name, block in blocks.items():
+        count = 0
+        for line in block.lines:
+            if line.mnemonic is not None and line.mnemonic[0] != '.':
+                kind = instruction_class(line.mnemonic)
+                classes[kind] += 1
+                cycles += CYCLES[kind] * LOOP_WEIGHT ** depths[name]
+                count += 1
+        counts[name] = count
+
+    loops = [(header, depths[header], sum(counts[x] for x in members))
+             for header, members in find_loops(blocks).items()]
+    return Cost(classes, sum(classes.values()), cycles, loops)
+
+
+def instruction_operands(line):
+    return [x.strip() for x in ' '.join(line.operands).split(',')] if line.operands else []
+
+
+def instruction_text(line):
+    return ' '.join([line.mnemonic] + [', '.join(instruction_operands(line))])
+
+
+# Text of a line without its instruction, keeping any label and comment, or None
+def without_instruction(line):
+    if line.label is not None:
+        return line.label + ':' + ('\t#' + line.comment if line.comment is not None else '')
+    if line.comment is None:
+        return None
+    return line.code[:len(line.code) - len(line.code.lstrip())] + '#' + line.comment
+
+
+# A move of a register to itself, or adding zero to a register in place
+def self_move(line, following, labels):
+    operands = instruction_operands(line)
+    mnemonic = line.mnemonic
+    if len(operands) == 2 and mnemonic == 'move':
+        useless = operands[0] == operands[1]
+    elif len(operands) == 3 and mnemonic in ('add', 'addu', 'sub', 'subu', 'or'):
+        useless = operands[0] == operands[1] and operands[2] in ('$zero', '$0')
+    elif len(operands) == 3 and mnemonic in ('addi', 'addiu'):
+        useless = operands[0] == operands[1] and operands[2] == '0'
+    else:
+        useless = False
+    if useless:
+        return 0, without_instruction(line), "'{}' has no effect".format(instruction_text(line))
+
+
+# A load of the word just stored, reached from nowhere else
+def store_then_load(line, following, labels):
+    if line.mnemonic != 'sw' or following is None or following.mnemonic != 'lw' or labels:
+        return None
+    stored, loaded = instruction_operands(line), instruction_operands(following)
+    if len(stored) != 2 or len(loaded) != 2 or stored[1].replace(' ', '') != loaded[1].replace(' ', ''):
+        return None
+    if loaded[0] == stored[0]:
+        return 1, without_instruction(following), "'{}' loads the value just stored".format(
+            instruction_text(following))
+    move = '\tmove\t{}, {}'.format(loaded[0], stored[0])
+    if following.comment is not None:
+        move += '\t#' + following.comment
+    return 1, move, "'{}' replaced by 'move {}, {}'".format(instruction_text(following), loaded[0], stored[0])
+
+
+# A constant loaded into a register which the next instruction writes without reading
+def overwritten_load_immediate(line, following, labels):
+    if line.mnemonic != 'li' or following is None:
+        return None
+    operands = instruction_operands(line)
+    defs, uses = line_registers(following)
+    if operands and operands[0] in defs and operands[0] not in uses:
+        return 0, without_instruction(line), "'{}' is overwritten by the next instruction".format(
+            instruction_text(line))
+
+
+# A jump or branch to the label right after it
+def jump_to_next_label(line, following, labels):
+    if line.mnemonic in LINK_MNEMONICS:
+        return None
+    target, _ = control_flow(line)
+    if target is not None and target in labels:
+        return 0, without_instruction(line), "'{}' jumps to the next instruction".format(instruction_text(line))
+
+
+# Rewrites of an instruction, given the next instruction and the labels up to it, which never change what code does.
+# Each returns None, or which of the two to replace (0 or 1), the text to replace it with (None to remove it)
+# and a description.
+PEEPHOLE_RULES = (self_move, store_then_load, overwritten_load_immediate, jump_to_next_label)
+
+
+# Apply PEEPHOLE_RULES to the lines of a function until none applies, returning the text and rewrites
+def peephole(lines):
+    lines = list(lines)
+    rewrites = []
+    while True:
+        # Directives between two instructions, such as data after a jump, keep them from being paired
+        statements = [i for i, line in enumerate(lines) if line.mnemonic is not None]
+        replaced = {}
+        for i, j in zip(statements, statements[1:] + [len(lines)]):
+            if i in replaced or lines[i].mnemonic[0] == '.':
+                continue
+            following = lines[j] if j < len(lines) and lines[j].mnemonic[0] != '.' else None
+            labels = {line.label for line in lines[i + 1:j + (following is not None)] if line.label is not None}
+            for rule in PEEPHOLE_RULES:
+                rewrite = rule(lines[i], following, labels)
+                if rewrite is not None:
+                    position, text, description = rewrite
+                    target = lines[(i, j)[position]]
+                    replaced[(i, j)[position]] = text
+                    rewrites.append((target.num, description))
+                    break
+
+        if not replaced:
+            return [line.text for line in lines], rewrites
+        lines = [line if i not in replaced else tokenize_line(replaced[i], line.num)
+                 for i, line in enumerate(lines) if i not in replaced or replaced[i] is not None]
+
+
+STREAM_FILENAME = '-'
+SOURCE_SUFFIX = '.s'
+GENERATED_SUFFIXES = ('.pretty.s', '.out.s')
+
+# Messages written at a time, so that the log of long runs such as streams is never held in memory as a whole
+LOG_BATCH_SIZE = 1024
+
+WATCH_INTERVAL = 0.25
+WATCH_DEBOUNCE = 0.5
+
+# Smallest part of a file prettified by each process, files of fewer parts are prettified serially
+PRETTIFY_CHUNK_SIZE = 2 ** 20
+# Line endings other than \n, which would make numbering lines by counting \n wrong
+LONE_CARRIAGE_RETURN_PATTERN = re.compile(rb"\r(?!\n)")
+
+# Version of the layout of cache entries, entries of other versions are never read
+CACHE_FORMAT = 5
+CACHE_MAX_BYTES = 64 * 2 ** 20
+# Fraction of the maximum size the cache is evicted down to, so that it is only evicted once in a while
+CACHE_EVICT_RATIO = 0.75
+CACHE_MEMORY_MAX_BYTES = 16 * 2 ** 20
+# Arguments which never change the outputs or log of a single file
+UNCACHED_ARGS = ('file', 'version', 'jobs', 'watch', 'serve', 'timings', 'profile', 'color', 'diagnostics',
+                 'check', 'diff', 'no_cache', 'cache_dir')
+# Options which never change the results of a function, given its lines and the functions inside it
+FUNCTION_UNCACHED_OPTIONS = ('prettify', 'space', 'extra_functions')
+
+
+# Write through a temporary file and a rename, so that readers never see a half written file
+def write_atomic(path, text):
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, path_temp = mkstemp(dir=directory, prefix='.' + name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        try:
+            copymode(path, path_temp)
+        except OSError:
+            # New files get the usual permissions rather than those of temporary files
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(path_temp, 0o666 & ~umask)
+        os.replace(path_temp, path)
+    except BaseException:
+        os.remove(path_temp)
+        raise
+
+
+# Write unless the file already holds the text, returning whether it wrote
+def write_if_changed(path, text):
+    try:
+        if os.path.getsize(path) == len(text.encode()):
+            with open(path, 'r') as f:
+                if f.read() == text:
+                    return False
+    except (OSError, UnicodeError):
+        pass
+    write_atomic(path, text)
+    return True
+
+
+# On-disk cache of processed outputs, with the recently used entries also kept in memory
+class ResultCache:
+    memory = OrderedDict()
+    memory_bytes = 0
+    # Size of each cache directory as counted by this process
+    directory_bytes = {}
+
+    def __init__(self, directory=None, max_bytes=CACHE_MAX_BYTES, persistent=True):
+        self.directory = directory or self.default_directory()
+        self.max_bytes = max_bytes
+        # Only the memory layer is used when not persistent
+        self.persistent = persistent
+
+    @classmethod
+    def remember(cls, key, entry, size):
+        cls.forget(key)
+        if size > CACHE_MEMORY_MAX_BYTES:
+            return
+        cls.memory[key] = (entry, size)
+        cls.memory_bytes += size
+        while cls.memory_bytes > CACHE_MEMORY_MAX_BYTES:
+            cls.memory_bytes -= cls.memory.popitem(last=False)[1][1]
+
+    @classmethod
+    def recall(cls, key):
+        if key not in cls.memory:
+            return None
+        cls.memory.move_to_end(key)
+        return cls.memory[key][0]
+
+    @classmethod
+    def forget(cls, key):
+        if key in cls.memory:
+            cls.memory_bytes -= cls.memory.pop(key)[1]
 
     @staticmethod
-    def append_filename_suffix(filename, suffix):
-        path_parts = filename.rpartition('.')
-        return path_parts[0] + suffix + path_parts[1] + path_parts[2]
+    def default_directory():
+        if os.environ.get('MPPD_CACHE_DIR'):
+            return os.environ['MPPD_CACHE_DIR']
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'mppd')
+
+    @staticmethod
+    def make_key(*parts):
+        digest = hashlib.sha256(str(CACHE_FORMAT).encode())
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            # Hash each part separately so that their boundaries are unambiguous
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        entry = self.recall(key)
+        if not self.persistent:
+            return entry
+        if entry is None:
+            try:
+                with open(path, 'r') as f:
+                    data = f.read()
+                entry = json.loads(data)
+            except (OSError, ValueError):
+                return None
+            self.remember(key, entry, len(data))
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        data = json.dumps(entry)
+        if len(data) > self.max_bytes:
+            return
+        self.remember(key, entry, len(data))
+        if not self.persistent:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_atomic(self.path(key), data)
+            self.grow(len(data))
+        except OSError:
+            # The cache is only an optimisation
+            pass
+
+    # Count bytes written, evicting entries once the cache grew too large
+    def grow(self, size):
+        sizes = self.directory_bytes
+        if self.directory in sizes:
+            sizes[self.directory] += size
+        else:
+            sizes[self.directory] = sum(x[1] for x in self.scan())
+        if sizes[self.directory] > self.max_bytes:
+            sizes[self.directory] = self.evict()
+
+    # Modification time, size and path of each entry
+    def scan(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    # Remove the least recently used entries down to CACHE_EVICT_RATIO, returning the size left
+    def evict(self):
+        entries = self.scan()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * CACHE_EVICT_RATIO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            self.forget(os.path.basename(path)[:-len('.json')])
+        return total
+
+
+# Options of Preprocessor, named after the command line arguments
+class Options(namedtuple('Options', 'prettify space extra_functions alloc optimize identifiers locals docs structure '
+                                    'cfg cost verbose quiet')):
+    __slots__ = ()
+
+    def __new__(cls, prettify=False, space=False, extra_functions=(), alloc='first-use', optimize=False,
+                identifiers=False, locals=False, docs=False, structure=False, cfg=None, cost=False, verbose=0,
+                quiet=False):
+        return super().__new__(cls, prettify, space, tuple(extra_functions), alloc, optimize, identifiers, locals,
+                               docs, structure, cfg, cost, verbose, quiet)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            prettify=args.prettify,
+            space=args.space,
+            extra_functions=[x.strip() for x in args.extra_functions or ()],
+            alloc=args.alloc,
+            optimize=args.optimize,
+            identifiers=args.identifiers,
+            locals=args.locals,
+            docs=args.docs,
+            structure=args.structure,
+            cfg=args.cfg,
+            cost=args.cost,
+            verbose=args.verbose or 0,
+            quiet=args.quiet,
+        )
+
+
+Result = namedtuple('Result', 'text identifiers docs diagnostics')
+Timing = namedtuple('Timing', 'stage function seconds lines bytes')
+
+
+# Messages logged within Preprocessor.recording(), dropped once they outgrow max_bytes
+class LogRecord(list):
+    def __init__(self, max_bytes=None):
+        super().__init__()
+        self.remaining = max_bytes
+        self.overflowed = False
+
+    def add(self, level, message):
+        if self.overflowed:
+            return
+        if self.remaining is not None:
+            self.remaining -= len(message)
+            if self.remaining < 0:
+                self.overflowed = True
+                self.clear()
+                return
+        self.append([level, message])
+
+
+# Prettifies and preprocesses assembly in memory, collecting messages in diagnostics
+class Preprocessor:
+    def __init__(self, options=None, cache=None, hooks=()):
+        self.options = options or Options()
+        self.cache = cache
+        self.hooks = list(hooks)
+        self.timings = []
+        self.level = WARNING if self.options.quiet else INFO
+        self.diagnostics = []
+        self.__log_records = []
+        self.__deferring = False
+        self.lines_changed = 0
+        self.functions_processed = 0
+        self.labels = LabelIndex(())
+        self.calls = CallGraph(())
+        self.summaries = {}
+        # Registers clobbered by the functions of other files called, by label, and those of each function
+        # composed with them and its callees
+        self.callee_clobbers = {}
+        self.clobbers = {}
+        # Cache entries of the functions processed, and those of an earlier run which may be reused
+        self.function_entries = {}
+        self.stored_functions = {}
+        self.identifiers = {}
+        self.docs = {}
+        self.costs = {}
+
+    def log(self, *values, level=INFO):
+        if level < self.level:
+            return
+        message = ' '.join(str(x) for x in values)
+        for record in self.__log_records:
+            record.add(level, message)
+        if not self.__deferring:
+            self.emit(message, level)
+
+    def emit(self, message, level=INFO):
+        self.diagnostics.append(ANSI_PATTERN.sub('', message))
+
+    # Collect the messages logged within the block, as well as emitting them
+    @contextmanager
+    def recording(self, max_bytes=None):
+        log = LogRecord(max_bytes)
+        self.__log_records.append(log)
+        try:
+            yield log
+        finally:
+            self.__log_records.pop()
+
+    # Collect the messages logged within the block instead of emitting them
+    @contextmanager
+    def deferred(self):
+        log = LogRecord()
+        records, deferring = self.__log_records, self.__deferring
+        self.__log_records, self.__deferring = [log], True
+        try:
+            yield log
+        finally:
+            self.__log_records, self.__deferring = records, deferring
+
+    # Time the block as a stage, counting its lines and bytes, and pass it to the hooks
+    @contextmanager
+    def timed(self, stage, lines=(), function=None):
+        counts = [0, 0]
+        start = time.perf_counter()
+        yield counts
+        seconds = time.perf_counter() - start
+        for line in lines:
+            counts[0] += 1
+            counts[1] += len(line.text if isinstance(line, Line) else line) + 1
+        timing = Timing(stage, function, seconds, counts[0], counts[1])
+        self.timings.append(timing)
+        for hook in self.hooks:
+            hook(timing)
+
+    def timings_report(self):
+        stages = OrderedDict()
+        functions = OrderedDict()
+        for timing in self.timings:
+            totals = functions if timing.stage == 'function' else stages
+            name = timing.function if timing.stage == 'function' else timing.stage
+            seconds, lines, size = totals.get(name, (0, 0, 0))
+            totals[name] = (seconds + timing.seconds, lines + timing.lines, size + timing.bytes)
+
+        report = []
+        for heading, totals in (('Timings', stages), ('Functions', functions)):
+            if totals:
+                report.append(heading + ':')
+            for name, (seconds, lines, size) in totals.items():
+                line = '  {:<28}{:>10.2f} ms'.format(name, seconds * 1000)
+                if lines:
+                    line += '{:>10} lines{:>12} bytes'.format(lines, size)
+                report.append(line)
+        return report
+
+    # Estimated cost of each function, the most expensive first
+    def cost_report(self):
+        report = ['Estimated cost:']
+        for name, cost in sorted(self.costs.items(), key=lambda x: -x[1].cycles):
+            report.append('  {:<28}{:>10} instructions{:>12} cycles'.format(name, cost.instructions, cost.cycles))
+        return '\n'.join(report) + '\n'
 
     @staticmethod
     def align_tabs(length, maximum):
         return '\t' * max(1, maximum - length // 4)
 
-    def fix_instruction_part_spacing(self, i):
-        s = i.split("\t")
-        parts = []
-        for a in s:
-            if len(a.strip()) > 0:
-                parts.append(a.strip())
-        if self.__args.verbose: print(parts)
-        if len(parts) != 2: return i
-        return (" " * 4) + parts[0] + (" " * (10 - len(parts[0])) + parts[1])
-
-    def fix_comment_spacing(self, text):
-        result = ""
-        lines = text.split("\n")
-        lineNum = 0
-        for l in lines:
-            if "\t" in l:
+    # Rows for align_block(), splitting tab separated instructions
+    def text_rows(self, lines, start=0):
+        verbose = self.options.verbose
+        fields = TAB_FIELD_PATTERN.findall
+        for lineNum, line in enumerate(lines, start):
+            l = line.text.rstrip()
+            t_count = l.count("\t") + 1
+            if t_count > 2:
+                if verbose == 2: self.log(lineNum, 'splitted', l.split("\t"))
+                comment = line.comment
+                if comment is not None:
+                    comment = comment.rstrip()
+                    if comment[:1] == ' ':
+                        comment = comment[1:]
+
+                parts = fields(line.code)
+                if verbose: self.log(parts)
+                if len(parts) == 2 and line.label is None:
+                    yield None, parts[0], parts[1], comment
+                elif len(parts) == 1 and line.label is None and line.is_indented and len(parts[0].split()) == 1:
+                    # A bare mnemonic, rather than an instruction without a tab before its operands
+                    yield None, parts[0], '', comment
+                else:
+                    yield line.code.rstrip(), None, None, comment
+                continue
+
+            # Provide linting feedback
+            elif t_count > 1:
+                if verbose == 2: self.log(lineNum, 'splitted', l.split("\t"))
                 splitted = l.split("\t")
-                t_count = len(splitted)
-                if self.__args.verbose == 2: print(lineNum, 'splitted', splitted)
-                if t_count > 2:
-                    s = l.split("# ")
-
-                    p_0 = s[0].rstrip()
-                    p_0 = self.fix_instruction_part_spacing(p_0)
-
-                    # Fix command comment split
-                    if len(s) == 2:
-                        l = p_0 + (" " * (52 - len(p_0))) + "# " + s[1]
-                    elif len(s) == 1:
-                        l = p_0
-
-                # Provide linting feedback
-                elif t_count > 1:
-                    if l[-1] != '#' and splitted[0] != '#' and len(splitted[1].split(" ")[0]) == 3:
-                        print(CRED + "Line {}: there is no tab between the instruction and arguments.".format(lineNum))
-                        print(CGREY + l.strip())
-                        print(CEND)
-
-                    # print(repr(l), len(s[0]))
-            result += l + "\n"
-            lineNum += 1
-        return result
+                if l[-1] != '#' and splitted[0] != '#' and len(splitted[1].split(" ")[0]) == 3:
+                    self.log(CRED + "Line {}: there is no tab between the instruction and arguments.".format(lineNum)
+                             + '\n' + CGREY + l.strip() + CEND + '\n', level=WARNING)
+            yield l, None, None, None
 
-    def prettify(self):
+    def fix_comment_spacing(self, lines):
+        texts = list(chain.from_iterable(aligned_blocks(self.text_rows(lines))))
+        return '\n'.join(texts) + '\n' if texts else ''
+
+    # Mnemonic, operands and comment of an instruction to prettify, or None
+    def instruction_parts(self, line):
         # Instructions without a comma in signature
         include_instructions = ('jal', 'jr', 'b')
 
-        if self.__args.replace:
-            path_backup = self.__args.file + '.bak'
-            copy2(self.__args.file, path_backup)
-            path_out = self.__args.file
-        else:
-            path_backup = self.__args.file
-            path_out = self.append_filename_suffix(self.__args.file, '.pretty')
-
-        file_input = open(path_backup, 'r')
-        outfile = open(path_out, 'w')
-        lines_changed = 0
-        out_buffer = ''
-
-        print(LOG_PRETTIFY_PREFIX)
-
-        for line_num, line in enumerate(file_input, start=1):
-            line = line.rstrip()
-            line_parts = line.partition('#')
-            stripped = line_parts[0].lstrip()
-
-            # If line starts with a tab or four spaces
-            is_indented: bool = line and (line[0] == '\t' or (len(line) > 4 and line[:3].isspace()))
-
-            # Handle lines with instructions
-            if (is_indented and stripped and stripped[0] != '#' and
-                    (',' in line or any(stripped.startswith(x) for x in include_instructions))):
-
-                split = stripped.split()
-                if self.__args.verbose:
-                    print('split', split)
-                line_out = "\t"
-
-                line_out += split[0]
-                instruction_len = len(split[0])
-                # Add whitespace after instruction code
-                if (1 < instruction_len <= 4) or split[0] in include_instructions:
-                    line_out += self.align_tabs(instruction_len, NUM_TABS_AFTER_INSTRUCTION)
-
-                # Add arguments
-                length = len(split)
-                len_args = 0
-                for i in range(1, length):
-                    # Insert space after commas
-                    comma_pos = split[i].find(',')
-                    if 0 <= comma_pos < len(split[i]) - 1:
-                        split[i] = ', '.join(split[i].split(',')).rstrip()
-
-                    line_out += split[i]
-                    len_args += len(split[i])
-
-                    if i != length - 1:
-                        line_out += ' '
-                        len_args += 1
-
-                # If line has comment
-                if line_parts[1]:
-                    line_out += self.align_tabs(len_args, NUM_TABS_BEFORE_COMMENT)
-                    line_out += line_parts[1] + ' ' + line_parts[2].lstrip()
-
-                if self.__args.verbose or line_out != line:
-                    print(CGREY + "Line " + str(line_num) + ": " + CEND + line)
-                    print(CVIOLET + "Line " + str(line_num) + ": " + CEND + line_out)
-                    lines_changed += 1
+        # Handle lines with instructions
+        if not (line.is_indented and line.mnemonic and
+                (',' in line.text or line.mnemonic.startswith(include_instructions))):
+            return None
+
+        split = [line.mnemonic]
+        split.extend(line.operands)
+        if self.options.verbose:
+            self.log('split', split)
+
+        # Insert space after commas
+        operands = []
+        for operand in line.operands:
+            comma_pos = operand.find(',')
+            if 0 <= comma_pos < len(operand) - 1:
+                operand = ', '.join(operand.split(',')).rstrip()
+            operands.append(operand)
+
+        comment = line.comment.strip() if line.comment is not None else None
+        return line.mnemonic, ' '.join(operands), comment
+
+    def format_instruction(self, line):
+        parts = self.instruction_parts(line)
+        return self.tab_layout(*parts) if parts is not None else None
+
+    def tab_layout(self, mnemonic, operands, comment):
+        # Add whitespace after instruction code, then arguments
+        line_out = '\t' + mnemonic + self.align_tabs(len(mnemonic), NUM_TABS_AFTER_INSTRUCTION) + operands
+
+        # If line has comment
+        if comment is not None:
+            line_out += self.align_tabs(len(operands), NUM_TABS_BEFORE_COMMENT)
+            line_out += '# ' + comment
+
+        return line_out
+
+    # Prettify lines lazily, a block at a time with --space
+    def prettify_lines(self, lines, start=1):
+        self.lines_changed = 0
+        lines = self.prettify_rows(lines, start)
+        return chain.from_iterable(aligned_blocks(lines)) if self.options.space else lines
+
+    # Prettified text of each line, or its row for align_block() with --space
+    def prettify_rows(self, lines, start=1):
+        for line in tokenize(lines, start):
+            parts = self.instruction_parts(line)
+            text = line.text.rstrip()
+
+            if parts is None:
+                line_out = text
             else:
-                line_out = line
-
-            if self.__args.space:
-                out_buffer += line_out + '\n'
+                line_out = self.tab_layout(*parts)
+                if self.options.verbose or line_out != text:
+                    self.log(CGREY + "Line " + str(line.num) + ": " + CEND + text)
+                    self.log(CVIOLET + "Line " + str(line.num) + ": " + CEND + line_out)
+                    self.lines_changed += 1
+
+            if not self.options.space:
+                yield line_out
+            elif parts is None:
+                yield next(self.text_rows((line,), line.num - 1))
             else:
-                outfile.write(line_out + '\n')
-
-        if self.__args.space:
-            outfile.write(self.fix_comment_spacing(out_buffer))
-
-        outfile.close()
-        file_input.close()
-
-        print("{} lines were reformatted.".format(lines_changed))
-        print("Prettified output written to '{}'".format(path_out))
-        if self.__args.replace:
-            print("Backup written to '{}'".format(path_backup))
-        print()
-        return path_out
+                yield (None,) + parts
 
     # Preprocessor functions
-    @staticmethod
-    def first_startswith(strings, substring):
-        return next((i for i, string in enumerate(strings) if string.startswith(substring)), -1)
+    def create_identifiers_mapping(self, lines):
+        if isinstance(lines, str):
+            lines = tokenize(lines.split("\n"))
+        lines = list(lines)
 
-    def create_identifiers_mapping(self, text):
-        available_registers = ["$t{}".format(i) for i in range(10)]
-        available_registers.extend("$s{}".format(i) for i in range(10))
         identifiers = {}
         identifiersFlags = {}
-        matches = re.finditer(IDENTIFIER_ARG_REGEX, text, re.MULTILINE)
-
-        if self.__args.verbose: idents = set()
+        # Identifiers in order of first appearance, and those with flags
+        order = []
+        flagged = set()
 
-        for matchNum, match in enumerate(matches, start=1):
-            identifier = match.group()
-            match_start = match.start()
-            new_line_start_pos = match.string[:match_start].rfind('\n')
-            if new_line_start_pos > 0:
-                if '#' in match.string[new_line_start_pos:match_start]:
-                    continue
+        if self.options.verbose: idents = set()
 
-            if '.' in identifier:
-                identifier_trim, _, flag = identifier.rpartition('.')
-                identifiersFlags[identifier] = identifier_trim
-                identifier = identifier_trim
-                print("Identifier '{}' has flag '{}'".format(identifier, flag))
+        for line in lines:
+            for start, end, identifier, flag in line.identifiers:
+                if flag is not None:
+                    identifiersFlags[line.text[start:end]] = identifier
+                    self.log("Identifier '{}' has flag '{}'".format(identifier, flag))
 
-                if identifier in identifiers:
-                    print(CRED + 'Identifier {} declared before flag {}'.format(identifier, flag) + CEND)
-                else:
-                    ident_index = self.first_startswith(available_registers, '$s')
-                    if ident_index != -1:
-                        identifiers[identifier] = available_registers[ident_index]
-                        available_registers.pop(ident_index)
+                    if identifier in identifiers:
+                        self.log(CRED + 'Identifier {} declared before flag {}'.format(identifier, flag) + CEND,
+                                 level=WARNING)
                     else:
-                        print(CRED + 'Identifier {} exceeded available $s registers'.format(identifier) + CEND)
-                continue
+                        identifiers[identifier] = None
+                        order.append(identifier)
+                        flagged.add(identifier)
+                    continue
 
-            if self.__args.verbose: idents.add(identifier)
+                if self.options.verbose: idents.add(identifier)
+
+                if identifier not in identifiers:
+                    identifiers[identifier] = None
+                    order.append(identifier)
+
+        if self.options.verbose: self.log(len(idents), idents)
+
+        # Identifiers which do not fit in registers are kept on the stack, using scratch registers
+        spilled = set()
+        scratch = 0
+        costs = None
+        # Identifiers which share registers, built once and dropping identifiers as they are spilled
+        graph = None
+        if self.options.alloc == 'liveness':
+            graph = interference_graph(lines, [x for x in order if x not in flagged])
+        while True:
+            identifiers, candidates = self.allocate_registers(order, flagged, spilled, scratch, graph)
+            if candidates:
+                if costs is None:
+                    costs = spill_costs(lines)
+                    position = {x: i for i, x in enumerate(order)}
+                    line_identifiers = [{x for _, _, x, _ in line.identifiers} for line in lines if line.identifiers]
+                # Spill the cheapest identifier, or the last to appear of equally cheap ones
+                identifier = min(candidates, key=lambda x: (costs.get(x, 0), -position[x]))
+                spilled.add(identifier)
+                if graph is not None:
+                    for x in graph.pop(identifier, ()):
+                        graph[x].discard(identifier)
+                continue
+            if not spilled:
+                break
 
-            if identifier not in identifiers:
-                identifiers[identifier] = available_registers[0]
-                available_registers.pop(0)
+            needed = max(len(x & spilled) for x in line_identifiers)
+            if needed <= scratch:
+                break
+            scratch = needed
 
-        if self.__args.verbose: print(len(idents), idents)
+        for offset, identifier in enumerate(x for x in order if x in spilled):
+            if identifier in flagged:
+                message = 'Identifier {} exceeded available $s registers, stored on the stack'
+            else:
+                message = 'Identifier {} exceeded available registers, stored on the stack'
+            self.log(CRED + message.format(identifier) + CEND, level=WARNING)
+            identifiers[identifier] = '{}($sp)'.format(4 * offset)
 
         return identifiers, identifiersFlags
 
-    @staticmethod
-    def perform_replacements(text, identifiers):
-        for i, r in sorted(identifiers.items(), key=lambda k: len(k[0]), reverse=True):
-            text = text.replace(i, r)
-        return text
+    # Map identifiers to registers, or return those which could be spilled to make room
+    def allocate_registers(self, order, flagged, spilled, scratch, graph=None):
+        # Temporary registers are handed out first, then saved registers
+        temporary_registers = deque("$t{}".format(i) for i in range(10 - scratch))
+        saved_registers = deque("$s{}".format(i) for i in range(10))
+        mapping = {}
+        kept = [x for x in order if x not in spilled]
+        liveness = graph is not None
+
+        for identifier in kept:
+            if identifier in flagged:
+                if not saved_registers:
+                    return mapping, [x for x in kept if x in flagged or mapping.get(x, '').startswith('$s')]
+                mapping[identifier] = saved_registers.popleft()
+            elif not liveness:
+                pool = temporary_registers if temporary_registers else saved_registers
+                if not pool:
+                    return mapping, kept
+                mapping[identifier] = pool.popleft()
+
+        shared = [x for x in kept if x not in flagged] if liveness else []
+        if shared:
+            # Identifiers which are never live at the same time share registers
+            registers = list(temporary_registers) + list(saved_registers)
+            for identifier in shared:
+                taken = {mapping[x] for x in graph[identifier] if x in mapping}
+                free = [x for x in registers if x not in taken]
+                if not free:
+                    return mapping, [identifier] + [x for x in graph[identifier] if x in mapping]
+                mapping[identifier] = free[0]
+
+        return {x: mapping[x] for x in order if x in mapping}, None
 
     @staticmethod
-    def extract_labels(text):
-        labels = []
-        matches = re.finditer(LABELS_REGEX, text, re.MULTILINE)
-        for matchNum, match in enumerate(matches, start=1):
-            labels.append(match.group())
-        return labels
+    def replace_identifiers(line, identifiers):
+        if not line.identifiers:
+            return line.text
 
-    def process(self):
-        if not self.__args.output:
-            self.__args.output = self.append_filename_suffix(self.__args.file, '.out')
+        # Rebuild the code part in one pass, leaving comments and unknown identifiers untouched
+        text = line.text
+        parts = []
+        last = 0
+        for start, end, identifier, flag in line.identifiers:
+            parts.append(text[last:start])
+            parts.append(identifiers.get(identifier, identifier))
+            last = end
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    # Replace identifiers, loading and storing those on the stack around each use
+    @classmethod
+    def spill_identifiers(cls, lines, identifiers, numbered=False):
+        slots = {k: int(v.partition('(')[0]) for k, v in identifiers.items() if v[0] != '$'}
+        frame_size = 4 * len(slots)
+        registers = set(identifiers.values())
+        scratch = [x for x in ("$t{}".format(i) for i in reversed(range(10))) if x not in registers]
+
+        result = []
+        numbers = []
+
+        def emit(line, text, before, after):
+            start = len(result)
+            if before and line.label is not None and line.mnemonic is not None:
+                # Instructions inserted before this one must come after its label
+                label, _, text = text.partition(':')
+                result.append(label + ':')
+                text = '\t' + text.lstrip()
+            if line.mnemonic is None:
+                result.append(text)
+                result.extend(before)
+            else:
+                result.extend(before)
+                result.append(text)
+            result.extend(after)
+            numbers.extend(repeat(line.num, len(result) - start))
+
+        # Bytes pushed onto the stack since entering the function, at the start of each block
+        offsets = {}
+        pushed = 0
+        for name, block in basic_blocks(lines).items():
+            pushed = offsets.setdefault(name, pushed)
+            for line in block.lines:
+                before = []
+                after = []
+                if line is lines[0]:
+                    before.append('\taddi\t$sp, $sp, -{}'.format(frame_size))
+
+                defs, uses = line_registers(line)
+                local = {}
+                for identifier in (x for _, _, x, _ in line.identifiers if x in slots):
+                    if identifier in local:
+                        continue
+                    if identifier in uses or identifier not in defs:
+                        local[identifier] = scratch[len(local)]
+                        before.append('\tlw\t{}, {}($sp)\t# {}'.format(
+                            local[identifier], slots[identifier] + pushed, identifier))
+                for identifier in (x for x in defs if x in slots):
+                    local.setdefault(identifier, scratch[0])
+                    after.append('\tsw\t{}, {}($sp)\t# {}'.format(
+                        local[identifier], slots[identifier] + pushed, identifier))
+
+                if line.mnemonic == 'jr' and '$ra' in uses:
+                    before.append('\taddi\t$sp, $sp, {}'.format(frame_size))
+
+                text = cls.replace_identifiers(line, dict(identifiers, **local))
+                emit(line, text, before, after)
+                pushed += stack_adjustment(line)
+
+            for successor in block.successors:
+                offsets.setdefault(successor, pushed)
+        return list(zip(numbers, result)) if numbered else result
 
-        # Run prettify
-        if self.__args.prettify or self.__args.prettify_only:
-            outfile_name = self.prettify()
-            if self.__args.prettify_only:
-                exit()
-            elif outfile_name:
-                self.__args.file = outfile_name
+    @staticmethod
+    def extract_labels(lines):
+        return [line.label for line in lines if line.label is not None]
+
+    # Reuse the results of unchanged functions from the cache or function_entries
+    def memoized_process_function(self, functionName, f_lines, function_names):
+        if self.cache is None:
+            self.functions_processed += 1
+            return self.process_function(functionName, f_lines, function_names)
+
+        options = {k: v for k, v in self.options._asdict().items() if k not in FUNCTION_UNCACHED_OPTIONS}
+        # Labels of other functions inside this one end its structure documentation
+        boundaries = [label for label in self.extract_labels(f_lines[1:]) if label in function_names]
+        key = ResultCache.make_key(__version__, functionName, json.dumps(options, sort_keys=True),
+                                   json.dumps(boundaries), '\n'.join(line.text for line in f_lines))
+
+        entry = self.cache.recall(key)
+        if entry is None:
+            entry = self.stored_functions.get(key)
+        if entry is not None:
+            self.function_entries[key] = entry
+            for level, message in entry['log']:
+                self.log(message, level=level)
+            summary = FunctionSummary(*(frozenset(x) for x in entry['summary']))
+            cost = entry['cost']
+            if cost is not None:
+                classes, instructions, cycles, loops = cost
+                cost = Cost(OrderedDict(classes), instructions, cycles, [tuple(x) for x in loops])
+            return entry['comment'], entry['lines'], entry['identifiers'], summary, cost
+
+        self.functions_processed += 1
+        with self.recording() as log:
+            comment, lines, identifiers, summary, cost = self.process_function(functionName, f_lines, function_names)
+        entry = self.function_entries[key] = {
+            'log': log, 'comment': comment, 'lines': lines, 'identifiers': identifiers,
+            'summary': [sorted(x) for x in summary],
+            'cost': [list(cost.classes.items())] + list(cost[1:]) if cost is not None else None,
+        }
+        # Sized by its lines, the bulk of it, rather than serialized
+        self.cache.remember(key, entry, sum(len(x) + 1 for x in lines))
+        return comment, lines, identifiers, summary, cost
+
+    # Map the identifiers of a function and document it, its clobbers leaving out its callees
+    def process_function(self, functionName, f_lines, function_names):
+        self.log(CGREEN + functionName + CEND)
+        with self.timed('create_identifiers_mapping', f_lines, functionName):
+            identifiers, identifiersFlags = self.create_identifiers_mapping(f_lines)
+        comment = []
+        summary = FunctionSummary(frozenset(), frozenset(), frozenset())
+        cost = None
+
+        # Perform pre-processing
+        spills = sum(1 for x in identifiers.values() if x[0] != '$')
+        with self.timed('perform_replacements', f_lines, functionName):
+            if spills:
+                replaced_lines = self.spill_identifiers(f_lines, identifiers, numbered=self.options.optimize)
             else:
-                exit(1)
+                replaced_lines = [self.replace_identifiers(line, identifiers) for line in f_lines]
+
+        if self.options.optimize:
+            with self.timed('optimize', f_lines, functionName):
+                if spills:
+                    numbered = replaced_lines
+                else:
+                    numbered = zip((line.num for line in f_lines), replaced_lines)
+                replaced_lines, rewrites = peephole(tokenize_line(text, num) for num, text in numbered)
+            for num, description in rewrites:
+                self.log(CYELLOW + 'Line {}: '.format(num) + CEND + description)
+
+        if self.options.identifiers:
+            self.log(CGREY + 'Identifiers ' + CEND + ' '.join(identifiers.keys()))
+            self.log(CGREY + 'Registers   ' + CEND + ' '.join(identifiers.values()))
+            self.log(CGREY + 'Sorted      ' + CEND + ' '.join(sorted(identifiers.values())))
+            self.log()
+
+        with self.timed('docs', f_lines, functionName):
+            FUNCTION_DOCS_INDENT = 8
 
-        available_registers = ["$t{}".format(i) for i in range(10)]
-        # available_registers.extend("$s{}".format(i) for i in range(10))
+            if self.options.locals or self.options.docs:
+                VARS_HEADING_INDENT = 12
+                LOCALS_HEADING = 'Locals:'
+                LOCALS_BULLET = '- '
 
-        # Open file
-        text = open(self.__args.file, "r").read()
-        lines = text.split("\n")
+                headingPrefix = '<' + str(VARS_HEADING_INDENT)
+
+                if spills or self.options.optimize:
+                    # Scratch registers, and instructions removed, are only known from the output
+                    index = RegisterIndex.build(tokenize(replaced_lines))
+                else:
+                    index = RegisterIndex.build(f_lines, identifiers)
+                referenced = index.referenced
+
+                # Frame
+                savedIdents = SAVED_REGISTERS & referenced
+                frameIdents = savedIdents | (FRAME_REGISTERS & referenced)
+                comment.append(format('Frame: ', headingPrefix) + ', '.join(sorted(frameIdents)))
+
+                # Uses
+                usedIdents = ((TEMPORARY_REGISTERS | ARGUMENT_REGISTERS) & referenced) | savedIdents
+                comment.append(format('Uses: ', headingPrefix) + ', '.join(sorted(usedIdents)))
+
+                # Clobbers
+                clobbers = (TEMPORARY_REGISTERS | ARGUMENT_REGISTERS) & index.defs.keys()
+                comment.append(self.format_clobbers(clobbers))
+                summary = FunctionSummary(frozenset(usedIdents), frozenset(clobbers), frozenset(savedIdents))
+
+                # Stack space added for identifiers which did not fit in registers
+                if spills:
+                    comment.append(format('Spills: ', headingPrefix) + '{} bytes'.format(4 * spills))
+
+                # Locals
+                if identifiers:
+                    comment.append('')
+                    comment.append(LOCALS_HEADING)
+                    localsFormat = '{:>' + str(FUNCTION_DOCS_INDENT) + "}"
+                    localsFormat += "'{}' in {}"
+                    # Registers first, then stack slots by offset
+                    order = sorted(identifiers.items(), key=lambda x: (x[1][0] != '$', len(x[1]), x[1]))
+                    for value, group in groupby(order, key=operator.itemgetter(1)):
+                        names = "', '".join(key[1:] for key, _ in group)
+                        comment.append(localsFormat.format(LOCALS_BULLET, names, value))
+
+            if self.options.cost:
+                # Static instruction counts and cycles
+                COST_HEADING = 'Cost:'
+                COST_BULLET = '- '
+
+                cost = static_cost(tokenize(replaced_lines) if spills or self.options.optimize else f_lines)
+                costFormat = '{:>' + str(FUNCTION_DOCS_INDENT) + "}"
+                costFormat += "{}"
+                classes = ', '.join('{} {}'.format(n, kind) for kind, n in cost.classes.items() if n)
+                comment.append('')
+                comment.append(COST_HEADING)
+                comment.append(costFormat.format(COST_BULLET, '{} instructions'.format(cost.instructions) +
+                                                 (': ' + classes if classes else '')))
+                comment.append(costFormat.format(COST_BULLET, '{} cycles, with each loop run {} times'.format(
+                    cost.cycles, LOOP_WEIGHT)))
+                for header, depth, instructions in cost.loops:
+                    comment.append(costFormat.format(COST_BULLET, 'loop {}: {} instructions, depth {}'.format(
+                        header, instructions, depth)))
+
+            if self.options.cfg:
+                # Basic blocks and their successors
+                CFG_HEADING = 'Control flow:'
+                CFG_BULLET = '- '
+
+                blocks = basic_blocks(f_lines)
+                comment.append('')
+                comment.append(CFG_HEADING)
+                if self.options.cfg == 'dot':
+                    comment.append('digraph "{}" {{'.format(functionName))
+                    for block in blocks.values():
+                        if not block.successors:
+                            comment.append('    "{}";'.format(block.name))
+                        for successor in block.successors:
+                            comment.append('    "{}" -> "{}";'.format(block.name, successor))
+                    comment.append('}')
+                else:
+                    cfgFormat = '{:>' + str(FUNCTION_DOCS_INDENT) + "}"
+                    cfgFormat += "{}"
+                    for block in blocks.values():
+                        edges = ' -> ' + ', '.join(block.successors) if block.successors else ''
+                        comment.append(cfgFormat.format(CFG_BULLET, block.name + edges))
+            elif self.options.structure:
+                # Structure
+                STRUCTURE_HEADING = 'Structure:'
+                STRUCTURE_BULLET = '- '
+
+                structureFormat = '{:>' + str(FUNCTION_DOCS_INDENT) + "}"
+                structureFormat += "{}"
+                comment.append('')
+                comment.append(STRUCTURE_HEADING)
+                # The first label owned by a function is its own
+                for label in self.labels.functions.get(functionName, [functionName])[1:]:
+                    comment.append(structureFormat.format(STRUCTURE_BULLET, label))
+
+        return comment, replaced_lines, identifiers, summary, cost
+
+    @staticmethod
+    def format_clobbers(clobbers):
+        return format('Clobbers:', '<12') + ', '.join(sorted(clobbers))
 
+    # Preprocess the functions of some lines, returning the output text
+    def preprocess_lines(self, lines):
         # Read all labels
-        labels = self.extract_labels(text)
-        if self.__args.verbose: print(labels)
+        labels = self.extract_labels(lines)
+        if self.options.verbose: self.log(labels)
 
         # Default function names
         function_names_set = {"main", "run_generation", "print_generation"}
 
         # Add extra functions from arguments
-        if self.__args.extra_functions:
-            function_names_set.update([x.strip() for x in self.__args.extra_functions])
+        if self.options.extra_functions:
+            function_names_set.update(self.options.extra_functions)
 
-        # Get function names in order
-        function_names = []
-        for label in labels:
-            label = label[:-1]
-            if label in function_names_set:
-                function_names.append(label)
+        # Get function names in order, along with the labels called
+        self.calls = CallGraph(lines, function_names_set)
+        function_names = self.calls.functions
+
+        if self.options.verbose:
+            self.log('functions', function_names)
 
-        if self.__args.verbose:
-            print('functions', function_names)
+        self.labels = LabelIndex(lines, function_names)
 
-        functions = dict(zip(function_names, [[] for x in range(len(function_names))]))
+        functions = {name: [] for name in function_names}
 
         functions_found = 0
         current_function = None
 
-        pre_text = ""
+        pre_lines = []
 
-        for l in lines:
-            l = l + "\n"
-            if functions_found < len(function_names) and l.startswith(function_names[functions_found]):
+        for line in lines:
+            if functions_found < len(function_names) and line.label == function_names[functions_found]:
                 current_function = function_names[functions_found]
                 functions_found += 1
-                functions[current_function].append(l)
+                functions[current_function].append(line)
             elif current_function is not None:
-                functions[current_function][0] += l
+                functions[current_function].append(line)
             else:
-                pre_text += l
+                pre_lines.append(line)
 
-        result_text = ""
+        result_lines = [line.text for line in pre_lines]
 
-        if self.__args.verbose: print(functions.keys())
+        if self.options.verbose: self.log(functions.keys())
 
+        # Clobbers of callees are only known once every function has been processed,
+        # so messages are held back until the documentation is complete
+        results = {}
         for functionName in function_names:
-            print(CGREEN + functionName + CEND)
-            f_text = functions[functionName]
-            f_text = f_text[0]
-            identifiers, identifiersFlags = self.create_identifiers_mapping(f_text)
-            comment = ""
-
-            if self.__args.identifiers:
-                print(CGREY + 'Identifiers ' + CEND + ' '.join(identifiers.keys()))
-                print(CGREY + 'Registers   ' + CEND + ' '.join(identifiers.values()))
-                print(CGREY + 'Sorted      ' + CEND + ' '.join(sorted(identifiers.values())))
-                print()
+            with self.timed('function', functions[functionName], functionName), self.deferred() as log:
+                results[functionName] = self.memoized_process_function(
+                    functionName, functions[functionName], function_names) + (log,)
+            self.summaries[functionName] = results[functionName][3]
 
-            FUNCTION_DOCS_INDENT = 8
+        external = self.calls.external
+        clobbers = self.clobbers = self.calls.compose({
+            name: summary.clobbers.union(*(self.callee_clobbers.get(x, ()) for x in external.get(name, ())))
+            for name, summary in self.summaries.items()})
 
-            if self.__args.locals or self.__args.docs:
-                VARS_HEADING_INDENT = 12
-                LOCALS_HEADING = 'Locals:'
-                LOCALS_BULLET = '- '
-                FRAME_REGISTERS = ('fp', 'ra', 'sp')
-                FRAME_REGISTERS = ('$' + x for x in FRAME_REGISTERS)
+        for functionName in function_names:
+            comment, f_lines, identifiers, summary, cost, log = results.pop(functionName)
+            if clobbers[functionName] != summary.clobbers:
+                comment = [self.format_clobbers(clobbers[functionName]) if line.startswith('Clobbers:') else line
+                           for line in comment]
+            for level, message in log:
+                self.log(message, level=level)
+            if comment:
+                self.log('\n'.join(comment) + '\n')
 
-                headingPrefix = '<' + str(VARS_HEADING_INDENT)
+            self.identifiers[functionName] = identifiers
+            self.docs[functionName] = comment
+            if cost is not None:
+                self.costs[functionName] = cost
+            if self.options.docs:
+                # Write documentation to output
+                # Comment header
+                max_length = max((len(l) for l in comment), default=0)
+                result_lines.append("#" * (max_length + 4))
+                result_lines.append('# ' + functionName)
+                result_lines.append('')
 
-                # Frame
-                allSavedIdents = ["$s" + str(i) for i in range(10)]
-                savedIdents = [x for x in allSavedIdents if (x in identifiers.values() or x in f_text)]
+                for cLine in comment:
+                    result_lines.append(('# ' if len(cLine) else '') + cLine)
 
-                frameIdents = savedIdents[:]
-                frameIdents.extend(x for x in FRAME_REGISTERS if (x in identifiers.values() or x in f_text))
-                comment += format('Frame: ', headingPrefix)
-                comment += ', '.join(sorted(frameIdents))
-                comment += '\n'
+            result_lines.extend(f_lines)
 
-                # Uses
-                usedIdents = ["$t" + str(i) for i in range(10)]
-                usedIdents.extend("$a" + str(i) for i in range(10))
-                usedIdents = [x for x in usedIdents if (x in identifiers.values() or x in f_text)]
-                usedIdents.extend(savedIdents)
-                savedIdents = None
-                comment += format('Uses: ', headingPrefix)
-                comment += ', '.join(sorted(usedIdents))
-                comment += '\n'
+        if self.costs:
+            self.log(self.cost_report())
 
-                # Clobbers
-                CLOBBERS_HEADING = 'Clobbers:'
-                clobbers = set(usedIdents).difference(frameIdents, allSavedIdents)
-                comment += format(CLOBBERS_HEADING, headingPrefix)
-                comment += ', '.join(sorted(clobbers))
-                comment += '\n'
+        with self.timed('fix_comment_spacing', result_lines):
+            return self.fix_comment_spacing(tokenize(result_lines))
 
-                # Locals
-                if identifiers:
-                    comment += '\n'
-                    comment += LOCALS_HEADING + '\n'
-                    localsFormat = '{:>' + str(FUNCTION_DOCS_INDENT) + "}"
-                    localsFormat += "'{}' in {}"
-                    for key, value in sorted(identifiers.items(), key=operator.itemgetter(1)):
-                        comment += localsFormat.format(LOCALS_BULLET, key[1:], value)
-                        comment += '\n'
 
-            if self.__args.structure:
-                # Structure
-                STRUCTURE_HEADING = 'Structure:'
-                STRUCTURE_BULLET = '- '
+# Prettifies and preprocesses a file, as configured by the command line arguments
+class MipsProcessor(Preprocessor):
+    def __init__(self, args, hooks=(), called_functions=(), callee_clobbers=None):
+        if isinstance(args.file, list):
+            # A processor handles a single input, see process_files() for several
+            if len(args.file) > 1:
+                raise ValueError('MipsProcessor takes a single input file')
+            args.file = args.file[0] if args.file else None
+        self.__args = args
+        self.path = args.file
+        # Keep stdout clean when it carries the output itself
+        self.__log_file = stderr if args.file == STREAM_FILENAME else None
+        # Messages are written in batches by flush()
+        self.__buffer = []
+        self.outputs = []
+
+        # Labels of the input called from other inputs, see process_files()
+        self.called_functions = sorted(called_functions)
+
+        cache = None
+        if not args.no_cache and args.file != STREAM_FILENAME:
+            cache = ResultCache(args.cache_dir)
+        options = Options.from_args(args)
+        options = options._replace(extra_functions=options.extra_functions + tuple(self.called_functions))
+        super().__init__(options, cache, hooks)
+        self.callee_clobbers = {k: sorted(v) for k, v in (callee_clobbers or {}).items()}
+
+    def emit(self, message, level=INFO):
+        self.__buffer.append((level, message))
+        if len(self.__buffer) >= LOG_BATCH_SIZE:
+            self.flush()
+
+    # Write the buffered messages, as text or JSON lines
+    def flush(self):
+        log_file = self.__log_file or sys.stdout
+        if self.__args.diagnostics == 'json':
+            lines = (diagnostic_json(level, self.path, message) for level, message in self.__buffer)
+        elif use_color(self.__args.color, log_file):
+            lines = (message for _, message in self.__buffer)
+        else:
+            lines = (ANSI_PATTERN.sub('', message) for _, message in self.__buffer)
+        text = ''.join(line + '\n' for line in lines)
+        self.__buffer = []
+        if text:
+            log_file.write(text)
+            log_file.flush()
 
-                found_start = False
-                structureFormat = '{:>' + str(FUNCTION_DOCS_INDENT) + "}"
-                structureFormat += "{}"
-                comment += '\n'
-                comment += STRUCTURE_HEADING + '\n'
-                for label in labels:
-                    label = label[:-1]
-                    if found_start:
-                        if label in function_names:
-                            break
-                        else:
-                            comment += structureFormat.format(STRUCTURE_BULLET, label)
-                            comment += '\n'
-                    elif label == functionName:
-                        found_start = True
+    @staticmethod
+    def append_filename_suffix(filename, suffix):
+        path_parts = filename.rpartition('.')
+        return path_parts[0] + suffix + path_parts[1] + path_parts[2]
 
-            if comment:
-                print(comment)
+    def prettify_stream(self, file_input, outfile):
+        with self.timed('prettify') as counts:
+            for line_out in self.prettify_lines(file_input):
+                outfile.write(line_out + '\n')
+                counts[0] += 1
+                counts[1] += len(line_out) + 1
 
-            # Perform pre-processing
-            f_text = self.perform_replacements(f_text, identifiersFlags)
-            f_text = self.perform_replacements(f_text, identifiers)
+    def prettify(self):
+        self.log(LOG_PRETTIFY_PREFIX)
+
+        if self.__args.file == STREAM_FILENAME:
+            self.prettify_stream(sys.stdin, sys.stdout)
+            sys.stdout.flush()
+            self.log("{} lines were reformatted.".format(self.lines_changed))
+            self.log()
+            return STREAM_FILENAME
+
+        text = self.prettify_chunks(self.__args.file, self.__args.jobs) if self.__args.jobs != 1 else None
+        if text is None:
+            outfile = StringIO()
+            with open(self.__args.file, 'r') as file_input:
+                self.prettify_stream(file_input, outfile)
+            text = outfile.getvalue()
+        self.log("{} lines were reformatted.".format(self.lines_changed))
+
+        # The source is only read again to be backed up
+        source = None
+        if self.__args.replace:
+            with open(self.__args.file, 'r') as file_input:
+                source = file_input.read()
+
+        path_out = self.__args.file
+        if self.__args.replace and text == source:
+            # Neither a backup nor a rewrite, which would only bump the modification time
+            self.log("'{}' is already formatted".format(path_out))
+        elif self.__args.replace:
+            path_backup = self.__args.file + '.bak'
+            write_if_changed(path_backup, source)
+            copystat(path_out, path_backup)
+            write_atomic(path_out, text)
+            self.outputs.extend((path_backup, path_out))
+            self.log("Prettified output written to '{}'".format(path_out))
+            self.log("Backup written to '{}'".format(path_backup))
+        else:
+            path_out = self.append_filename_suffix(self.__args.file, '.pretty')
+            if write_if_changed(path_out, text):
+                self.log("Prettified output written to '{}'".format(path_out))
+            else:
+                self.log("Prettified output '{}' is unchanged".format(path_out))
+            self.outputs.append(path_out)
+        self.log()
+        return path_out
 
-            if self.__args.docs:
-                # Write documentation to output
-                # Comment header
-                max_length = -1
-                for l in comment.split("\n"):
-                    max_length = max_length if len(l) < max_length else len(l)
-                result_text += "#" * (max_length + 4) + "\n"
-                comment = functionName + "\n\n" + comment
+    # Prettify a large file in parts in a process pool, or return None if it can't be split
+    def prettify_chunks(self, path, jobs):
+        workers = jobs or os.cpu_count()
+        separator = b'\n\n' if self.options.space else b'\n'
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            chunk_size = max(PRETTIFY_CHUNK_SIZE, size // (workers * 4))
+            if size < 2 * chunk_size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if LONE_CARRIAGE_RETURN_PATTERN.search(mm):
+                    return None
+                bounds = [0]
+                while bounds[-1] + chunk_size < size:
+                    end = mm.find(separator, bounds[-1] + chunk_size)
+                    if end < 0:
+                        break
+                    bounds.append(end + len(separator))
+                if bounds[-1] < size:
+                    bounds.append(size)
+                if len(bounds) < 3:
+                    return None
+                # Chunks are numbered from the line they start on
+                first_lines = [1]
+                for start, end in zip(bounds, bounds[1:-1]):
+                    first_lines.append(first_lines[-1] + mm[start:end].count(b'\n'))
+
+        with self.timed('prettify') as counts:
+            texts = []
+            self.lines_changed = 0
+            with ProcessPoolExecutor(max_workers=min(workers, len(first_lines))) as executor:
+                for text, lines_changed, log in executor.map(prettify_chunk, repeat(path), bounds, bounds[1:],
+                                                             first_lines, repeat(self.options)):
+                    texts.append(text)
+                    self.lines_changed += lines_changed
+                    for level, message in log:
+                        self.log(message, level=level)
+            text = ''.join(texts)
+            counts[:] = text.count('\n'), len(text)
+        return text
+
+    def cache_key(self):
+        options = {k: v for k, v in vars(self.__args).items() if k not in UNCACHED_ARGS}
+        with open(self.__args.file, 'rb') as f:
+            content = f.read()
+        return ResultCache.make_key(__version__, os.getcwd(), os.path.abspath(self.__args.file),
+                                    json.dumps(options, sort_keys=True), json.dumps(self.called_functions),
+                                    json.dumps(self.callee_clobbers, sort_keys=True), content)
+
+    # Key of the function entries of an input, written together rather than one file each
+    def functions_key(self):
+        return ResultCache.make_key(__version__, 'functions', os.getcwd(), os.path.abspath(self.path))
+
+    def restore(self, entry):
+        for path, text in entry['outputs']:
+            write_if_changed(path, text)
+            self.outputs.append(path)
+        for level, message in entry['log']:
+            self.log(message, level=level)
+        self.lines_changed = entry['lines_changed']
+        self.clobbers = {k: frozenset(v) for k, v in entry['clobbers'].items()}
+
+    def snapshot(self, log):
+        outputs = []
+        for path in self.outputs:
+            with open(path, 'r') as f:
+                outputs.append([path, f.read()])
+        clobbers = {k: sorted(v) for k, v in self.clobbers.items()}
+        return {'outputs': outputs, 'log': log, 'lines_changed': self.lines_changed, 'clobbers': clobbers}
+
+    # Run prettify and preprocessing, reusing the outputs of an earlier run if cached
+    def process(self):
+        try:
+            with self.timed('total'):
+                self.process_cached()
+            if self.__args.timings:
+                self.emit('\n'.join(self.timings_report()))
+        finally:
+            self.flush()
+
+    def process_cached(self):
+        # Inputs too large to be cached are not recorded either
+        if self.cache is None or os.path.getsize(self.__args.file) > self.cache.max_bytes:
+            return self.process_uncached()
+
+        with self.timed('cache'):
+            key = self.cache_key()
+            entry = self.cache.get(key)
+        if entry is not None:
+            self.restore(entry)
+            return
+
+        with self.recording(self.cache.max_bytes) as log:
+            self.process_uncached()
+        if not log.overflowed and sum(os.path.getsize(path) for path in self.outputs) <= self.cache.max_bytes:
+            self.cache.put(key, self.snapshot(log))
+
+    def process_uncached(self):
+        if not self.__args.output:
+            self.__args.output = self.append_filename_suffix(self.__args.file, '.out')
+
+        # Run prettify
+        if self.__args.prettify or self.__args.prettify_only:
+            outfile_name = self.prettify()
+            if self.__args.prettify_only:
+                return
+            elif outfile_name:
+                self.__args.file = outfile_name
+            else:
+                exit(1)
+
+        # Open file
+        with self.timed('tokenize') as counts:
+            with open(self.__args.file, "r") as file_input:
+                lines = list(tokenize(file_input))
+            counts[:] = len(lines), sum(len(line.text) + 1 for line in lines)
+
+        if self.cache is not None:
+            functions_key = self.functions_key()
+            self.stored_functions = self.cache.get(functions_key) or {}
+        text = self.preprocess_lines(lines)
+        if self.cache is not None and self.function_entries.keys() != self.stored_functions.keys():
+            self.cache.put(functions_key, self.function_entries)
+
+        with self.timed('write') as counts:
+            written = write_if_changed(self.__args.output, text)
+            counts[:] = text.count('\n'), len(text)
+        self.outputs.append(self.__args.output)
+        if written:
+            self.log("\nOutput written to '{}'".format(self.__args.output))
+        else:
+            self.log("\nOutput '{}' is unchanged".format(self.__args.output))
+
+
+# Prettify the lines between two offsets of a file, for prettify_chunks()
+def prettify_chunk(path, start, end, first_line, options):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    preprocessor = Preprocessor(options)
+    with preprocessor.recording() as log:
+        # Decoded as open() would, for the same text as serially
+        lines = preprocessor.prettify_lines(TextIOWrapper(BytesIO(data)), first_line)
+        text = ''.join(line + '\n' for line in lines)
+    return text, preprocessor.lines_changed, log
+
+
+# Prettify assembly held in a string, without touching the filesystem or stdout
+def prettify_text(text, options=None, hooks=()):
+    preprocessor = Preprocessor(options, hooks=hooks)
+    lines = []
+    with preprocessor.timed('prettify', lines):
+        lines.extend(preprocessor.prettify_lines(StringIO(text)))
+    text = ''.join(line + '\n' for line in lines)
+    return Result(text, {}, {}, preprocessor.diagnostics)
+
+
+# Preprocess assembly held in a string, without touching the filesystem or stdout
+def preprocess_text(text, options=None, cache=None, hooks=()):
+    preprocessor = Preprocessor(options, cache, hooks)
+    if preprocessor.options.prettify:
+        pretty = []
+        with preprocessor.timed('prettify', pretty):
+            pretty.extend(preprocessor.prettify_lines(StringIO(text)))
+        text = pretty
+    else:
+        text = StringIO(text)
+    lines = []
+    with preprocessor.timed('tokenize', lines):
+        lines.extend(tokenize(text))
+    text = preprocessor.preprocess_lines(lines)
+    return Result(text, preprocessor.identifiers, preprocessor.docs, preprocessor.diagnostics)
+
+
+# (number, line, prettified) of each line which prettify would change
+def unformatted_lines(lines, options=None):
+    preprocessor = Preprocessor((options or Options())._replace(quiet=True))
+    # Lines read but not yet prettified, since spaced output is laid out a block at a time
+    pending = deque()
+
+    def read():
+        for line in lines:
+            pending.append(line)
+            yield line
+
+    for number, line_out in enumerate(preprocessor.prettify_lines(read()), 1):
+        line = pending.popleft()
+        if line != line_out + '\n':
+            yield number, line, line_out
+
+
+# Report the inputs which prettify would change, without writing anything
+def check(args, paths):
+    options = Options.from_args(args)
+    changed = 0
+    errors = 0
+    for path in paths:
+        try:
+            file_input = sys.stdin if path == STREAM_FILENAME else open(path, 'r')
+        except OSError as e:
+            log_error('{}: {}'.format(path, e), args.color)
+            errors += 1
+            continue
+        try:
+            if args.diff:
+                lines = file_input.readlines()
+                pretty = [x + '\n' for x in Preprocessor(options._replace(quiet=True)).prettify_lines(lines)]
+                sys.stdout.writelines(unified_diff(lines, pretty, path, path + ' (prettified)'))
+                different = lines != pretty
+            else:
+                first = next(unformatted_lines(file_input, options), None)
+                different = first is not None
+                if different:
+                    print('{}:{}: would be reformatted'.format(path, first[0]))
+        finally:
+            if file_input is not sys.stdin:
+                file_input.close()
+
+        if different:
+            changed += 1
+            if not args.diff:
+                return 1
+
+    if args.check and not args.quiet and not changed:
+        print('{} files already formatted.'.format(len(paths) - errors))
+    return 1 if errors or (args.check and changed) else 0
+
+
+FileResult = namedtuple('FileResult', 'path log lines_changed functions_processed outputs error clobbers')
+
+
+# Sorted source files of input globs and directories, without duplicates
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = []
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                found.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.endswith(SOURCE_SUFFIX) and not name.endswith(GENERATED_SUFFIXES))
+            paths.extend(found)
+        elif has_magic(pattern):
+            paths.extend(sorted(glob(pattern, recursive=True)))
+        else:
+            paths.append(pattern)
+    return list(dict.fromkeys(paths))
+
+
+# Process one input with its log captured, so that several can run side by side
+def process_file(args, path, called_functions=(), callee_clobbers=None):
+    args = argparse.Namespace(**vars(args))
+    args.file = path
+    log = StringIO()
+    error = None
+    processor = MipsProcessor(args, called_functions=called_functions, callee_clobbers=callee_clobbers)
+    with redirect_stdout(log), redirect_stderr(log):
+        try:
+            processor.process()
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+    return FileResult(path, log.getvalue(), processor.lines_changed, processor.functions_processed,
+                      processor.outputs, error, {k: sorted(v) for k, v in processor.clobbers.items()})
+
+
+# Labels a file defines and calls, without lexing it
+def file_calls(path):
+    try:
+        with open(path, 'r') as f:
+            text = f.read()
+    except (OSError, UnicodeError):
+        return set(), set()
+    called = set()
+    for operands in CALL_OPERANDS_PATTERN.findall(text):
+        target = operands.split(',')[-1].strip()
+        # Calls through registers, as with jalr, have no target
+        if target and not OPERAND_REGISTER_PATTERN.match(target):
+            called.add(target)
+    return set(DEFINED_LABEL_PATTERN.findall(text)), called
+
+
+# Labels of each file called from any of the files
+def called_functions(calls):
+    calls = list(calls)
+    called = set().union(*(x for _, x in calls))
+    return [sorted(labels & called) for labels, _ in calls]
+
+
+# Positions of files in waves, each after the files whose functions it calls
+def call_waves(calls):
+    calls = list(calls)
+    defined = {}
+    for i, (labels, _) in enumerate(calls):
+        for label in labels:
+            defined.setdefault(label, set()).add(i)
+    callees = [set().union(*(defined.get(x, ()) for x in called - labels)) - {i}
+               for i, (labels, called) in enumerate(calls)]
+
+    waves = []
+    done = set()
+    remaining = list(range(len(calls)))
+    while remaining:
+        wave = [i for i in remaining if callees[i] <= done] or remaining[:1]
+        waves.append(wave)
+        done.update(wave)
+        remaining = [i for i in remaining if i not in done]
+    return waves
+
+
+# Results of each path, in order, processing files after those whose functions they call
+def process_files(args, paths, jobs=1):
+    # Functions may be called from other files than their own
+    find_calls = len(paths) > 1 and not args.prettify_only
+    if len(paths) > 1:
+        # Files are processed in parallel rather than parts of each
+        args = argparse.Namespace(**vars(args))
+        args.jobs = 1
+
+    if jobs == 1 or len(paths) == 1:
+        yield from process_waves(args, paths, find_calls, map)
+        return
+
+    workers = jobs or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def map_files(function, *iterables):
+            return executor.map(function, *iterables, chunksize=max(1, len(iterables[-1]) // (workers * 4)))
+
+        yield from process_waves(args, paths, find_calls, map_files)
+
+
+# Results of each path, in order, mapping each wave of files with map_files
+def process_waves(args, paths, find_calls, map_files):
+    if not find_calls:
+        yield from map_files(process_file, [args] * len(paths), paths)
+        return
+
+    calls = list(map_files(file_calls, paths))
+    called = called_functions(calls)
+    # Registers clobbered by the functions processed so far
+    clobbers = {}
+    results = {}
+    position = 0
+    for wave in call_waves(calls):
+        callee_clobbers = [{x: clobbers[x] for x in calls[i][1] - calls[i][0] if x in clobbers} for i in wave]
+        for i, result in zip(wave, map_files(process_file, [args] * len(wave), [paths[i] for i in wave],
+                                             [called[i] for i in wave], callee_clobbers)):
+            for name, registers in result.clobbers.items():
+                clobbers[name] = clobbers[name].union(registers) if name in clobbers else frozenset(registers)
+            results[i] = result
+            while position in results:
+                yield results.pop(position)
+                position += 1
+
+
+# Polls inputs for changes to the modification time or size of files
+class Watcher:
+    def __init__(self, patterns, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+        self.patterns = patterns
+        self.interval = interval
+        self.debounce = debounce
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+        for path in expand_inputs(self.patterns):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    # Files created or modified since the last poll
+    def poll(self):
+        state = self.snapshot()
+        changed = [path for path, stat in state.items() if self.state.get(path) != stat]
+        self.state = state
+        return changed
+
+    # Block until files change, then until they have been quiet for the debounce period
+    def wait(self, sleep=time.sleep):
+        changed = []
+        while not changed:
+            sleep(self.interval)
+            changed = self.poll()
+
+        quiet = 0
+        while quiet < self.debounce:
+            sleep(self.interval)
+            more = self.poll()
+            if more:
+                changed.extend(path for path in more if path not in changed)
+                quiet = 0
+            else:
+                quiet += self.interval
+        return changed
+
+
+# Lines added and removed between two versions of a text
+def diff_summary(before, after):
+    added = removed = 0
+    matcher = SequenceMatcher(None, before.splitlines(), after.splitlines(), autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            removed += i2 - i1
+            added += j2 - j1
+    return '+{} -{}'.format(added, removed)
+
+
+# Process the inputs, then again whenever they are saved
+def watch(args, sleep=time.sleep, iterations=None):
+    watcher = Watcher(args.file)
+    outputs = {}
+    changed = list(watcher.state)
+
+    while True:
+        for path in changed:
+            start = time.perf_counter()
+            result = process_file(args, path)
+            elapsed = time.perf_counter() - start
+
+            if result.error:
+                log_error('{}: {}'.format(path, result.error), args.color)
+                continue
+            if args.verbose:
+                print(result.log, end='')
+
+            summary = []
+            for output in result.outputs:
+                with open(output, 'r') as f:
+                    text = f.read()
+                if output in outputs and output != path:
+                    summary.append('{} {}'.format(output, diff_summary(outputs[output], text)))
+                outputs[output] = text
+            print('{} {} in {:.0f} ms, {} functions processed{}'.format(
+                time.strftime('%H:%M:%S'), path, elapsed * 1000, result.functions_processed,
+                ''.join(', ' + x for x in summary)))
+            sys.stdout.flush()
+
+        # Ignore changes made by processing itself, such as --replace
+        watcher.state = watcher.snapshot()
+
+        if iterations is not None:
+            iterations -= 1
+            if iterations <= 0:
+                return
+        changed = watcher.wait(sleep)
+
+
+# A request with invalid parameters
+class ParamsError(ValueError):
+    pass
+
+
+# Answers JSON-RPC and Language Server Protocol requests on a pair of binary streams
+class Server:
+    def __init__(self, infile, outfile):
+        self.infile = infile
+        self.outfile = outfile
+        self.documents = {}
+        self.cache = ResultCache(persistent=False)
+        self.running = False
+        self.methods = {
+            'initialize': self.initialize,
+            'initialized': lambda params: None,
+            'shutdown': lambda params: None,
+            'exit': self.exit,
+            'textDocument/didOpen': self.did_open,
+            'textDocument/didChange': self.did_change,
+            'textDocument/didClose': self.did_close,
+            'textDocument/formatting': self.formatting,
+            'mppd/prettify': self.prettify,
+            'mppd/preprocess': self.preprocess,
+            'mppd/docs': self.docs,
+        }
+
+    def read_message(self):
+        length = None
+        while True:
+            header = self.infile.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.decode('ascii').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        if length is None:
+            raise ValueError('missing Content-Length header')
+        return self.infile.read(length)
+
+    def write_message(self, message):
+        body = json.dumps(message).encode('utf-8')
+        self.outfile.write('Content-Length: {}\r\n\r\n'.format(len(body)).encode('ascii') + body)
+        self.outfile.flush()
+
+    def serve(self):
+        self.running = True
+        while self.running:
+            try:
+                body = self.read_message()
+            except ValueError as e:
+                self.write_message({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': str(e)}})
+                continue
+            if body is None:
+                break
+            try:
+                message = json.loads(body.decode('utf-8'))
+            except ValueError as e:
+                self.write_message({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': str(e)}})
+                continue
+            response = self.handle(message)
+            if response is not None:
+                self.write_message(response)
+
+    # Response to a request, or None for notifications
+    def handle(self, message):
+        handler = self.methods.get(message.get('method'))
+        if 'id' not in message:
+            if handler is not None:
+                try:
+                    handler(message.get('params') or {})
+                except Exception:
+                    # Notifications have nowhere to report errors to
+                    pass
+            return None
+
+        response = {'jsonrpc': '2.0', 'id': message['id']}
+        if handler is None:
+            response['error'] = {'code': -32601, 'message': 'Method not found: {}'.format(message.get('method'))}
+            return response
+        try:
+            response['result'] = handler(message.get('params') or {})
+        except (ParamsError, KeyError, TypeError) as e:
+            response['error'] = {'code': -32602, 'message': 'Invalid params: {}'.format(e)}
+        except Exception as e:
+            response['error'] = {'code': -32603, 'message': '{}: {}'.format(type(e).__name__, e)}
+        return response
+
+    def initialize(self, params):
+        return {
+            'capabilities': {'textDocumentSync': 1, 'documentFormattingProvider': True},
+            'serverInfo': {'name': 'mppd', 'version': __version__},
+        }
+
+    def exit(self, params):
+        self.running = False
+
+    def did_open(self, params):
+        document = params['textDocument']
+        self.documents[document['uri']] = document['text']
+
+    def did_change(self, params):
+        # Only full document synchronisation is supported
+        self.documents[params['textDocument']['uri']] = params['contentChanges'][-1]['text']
+
+    def did_close(self, params):
+        self.documents.pop(params['textDocument']['uri'], None)
+
+    def text(self, params):
+        if 'text' in params:
+            return params['text']
+        uri = params['uri'] if 'uri' in params else params['textDocument']['uri']
+        if uri not in self.documents:
+            raise ParamsError('document {} is not open'.format(uri))
+        return self.documents[uri]
+
+    @staticmethod
+    def options(params, **defaults):
+        defaults.update(params.get('options') or {})
+        return Options(**defaults)
+
+    def cached(self, method, text, options, function):
+        key = ResultCache.make_key(__version__, method, json.dumps(options._asdict(), sort_keys=True), text)
+        result = self.cache.get(key)
+        if result is None:
+            result = function(text, options)
+            result = {
+                'text': result.text,
+                'identifiers': result.identifiers,
+                'docs': result.docs,
+                'diagnostics': result.diagnostics,
+            }
+            self.cache.put(key, result)
+        return result
 
-                for cLine in comment.splitlines():
-                    result_text += ('# ' if len(cLine) else '') + cLine + '\n'
+    def formatting(self, params):
+        text = self.text(params)
+        formatting = params.get('options') or {}
+        options = Options(space=bool(formatting.get('insertSpaces')))
+        formatted = self.cached('prettify', text, options, prettify_text)['text']
+        if formatted == text:
+            return []
+        lines = text.split('\n')
+        end = {'line': len(lines) - 1, 'character': len(lines[-1])}
+        return [{'range': {'start': {'line': 0, 'character': 0}, 'end': end}, 'newText': formatted}]
 
-            result_text += f_text
+    def prettify(self, params):
+        result = self.cached('prettify', self.text(params), self.options(params), prettify_text)
+        return {'text': result['text'], 'diagnostics': result['diagnostics']}
 
-        # text = perform_replacements(text, identifiers)
+    def preprocess(self, params):
+        return self.cached('preprocess', self.text(params), self.options(params),
+                           lambda text, options: preprocess_text(text, options, self.cache))
 
-        # r = fix_comment_spacing(result_text)
-        # print(r)
-        with open(self.__args.output, "w") as f:
-            f.write(self.fix_comment_spacing(pre_text + result_text))
-        print("\nOutput written to '{}'".format(self.__args.output))
+    def docs(self, params):
+        result = self.cached('preprocess', self.text(params), self.options(params, docs=True),
+                             lambda text, options: preprocess_text(text, options, self.cache))
+        return {'docs': result['docs']}
 
 
 def get_arg_parser():
@@ -427,11 +2373,15 @@ def get_arg_parser():
               $ mppd code.s --prettify --replace
               $ mppd code.s --function min --function max
               $ mppd code.s -p -r -l -d -s
+              $ mppd - -P < code.s > pretty.s
+              $ mppd labs/ "extra/**/*.s" -p -r -j 4
+              $ mppd code.s -p -d -l -s --watch
             '''),
         description=__description__
     )
 
-    parser.add_argument("file", help="Input filename of assembly code", nargs='?')
+    parser.add_argument("file", help="Input filenames, globs or directories of assembly code, "
+                                     "or - to prettify stdin to stdout", nargs='*')
     parser.add_argument("-o", "--out", dest="output",
                         help="Output filename", metavar="OUT")
 
@@ -439,7 +2389,12 @@ def get_arg_parser():
     parser.add_argument("-V", "--verbose", type=int, nargs='?', const=1,
                         help="Logging level 1-2, defaults to 1 if no LEVEL supplied",
                         metavar="LEVEL")
-    # parser.add_argument("-q", "--quiet", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Only report warnings and errors")
+    parser.add_argument("--color", choices=("auto", "always", "never"), default="auto",
+                        help="Color messages, by default only when writing to a terminal")
+    parser.add_argument("--diagnostics", choices=("text", "json"), default="text",
+                        help="Report messages as text, or as JSON lines with their level and file")
 
     parser.add_argument("-p", "--prettify", action="store_true",
                         help="Reformat assembly code")
@@ -447,11 +2402,21 @@ def get_arg_parser():
                         help="Skip pre-processing")
     parser.add_argument("-r", "--replace", action="store_true",
                         help="In-place prettify, replace input file")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with an error at the first input which prettify would change, without writing files")
+    parser.add_argument("--diff", action="store_true",
+                        help="Write a diff of the changes prettify would make to each input, without writing files")
     parser.add_argument("-S", "--space", action="store_true",
                         help="Uses spaces instead of tabs for prettifying")
 
     parser.add_argument("-f", "--add-function", action="append", dest="extra_functions",
                         help="Append function to list of functions to process", metavar="LABEL")
+    parser.add_argument("--alloc", choices=("first-use", "liveness"), default="first-use",
+                        help="Give each identifier its own register in order of first use, "
+                             "or share registers between identifiers which are not live at the same time")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Remove instructions which have no effect from preprocessed functions, "
+                             "reporting each rewrite")
 
     parser.add_argument("-i", "--identifiers", action="store_true",
                         help="Show identifiers and registers lists")
@@ -462,6 +2427,27 @@ def get_arg_parser():
                         help="Write generated documentation to output")
     parser.add_argument("-s", "--structure", action="store_true",
                         help="Include label structures in documentation")
+    parser.add_argument("--cfg", choices=("text", "dot"),
+                        help="Document the basic blocks of functions and their successors, "
+                             "as text or in the DOT language, instead of their labels")
+    parser.add_argument("--cost", action="store_true",
+                        help="Document the instructions of functions by class and estimate the cycles they take")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of files, or parts of a large file, to process in parallel, 0 for one per CPU",
+                        metavar="N")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Keep running and process files again whenever they are saved")
+    parser.add_argument("--timings", action="store_true",
+                        help="Report the time taken by each stage of processing and by each function")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Write cProfile statistics to a file, which can be read with pstats")
+    parser.add_argument("--serve", action="store_true",
+                        help="Answer JSON-RPC requests on stdin, such as formatting requests from an editor")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        help="Always process files, instead of reusing cached results of unchanged files")
+    parser.add_argument("--cache-dir", dest="cache_dir", metavar="DIR",
+                        help="Directory of the result cache, defaults to ~/.cache/mppd")
 
     return parser
 
@@ -470,23 +2456,115 @@ def main():
     parser = get_arg_parser()
     args = parser.parse_args()
 
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, parser, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        run(parser, args)
+
+
+def run(parser, args):
     # Normalise arguments
     if args.version:
         print('v' + __version__)
         exit()
 
-    print(__description__ + '\n' + __copyright__ + '\n')
+    if args.serve:
+        # Nothing else may be written to stdout
+        Server(sys.stdin.buffer, sys.stdout.buffer).serve()
+        return
+
+    streaming = args.file == [STREAM_FILENAME]
+    log_file = stderr if streaming else None
+    # As given, since args.color is decided for stdout when the logs of files are captured
+    color = args.color
+
+    text = args.diagnostics == 'text'
+    if text and not (args.quiet or args.check or args.diff):
+        print(__description__ + '\n' + __copyright__ + '\n', file=log_file)
 
     if args.verbose:
-        print('Args', args)
+        print('Args', args, file=log_file)
+
+    paths = expand_inputs(args.file)
+    if not paths:
+        parser.print_usage(stderr)
+        log_error('no input file specified', color)
+        exit(1)
 
-    if not args.file:
+    if STREAM_FILENAME in paths and not (streaming and (args.prettify_only or args.check or args.diff)):
         parser.print_usage(stderr)
-        log_error('no input file specified')
+        log_error('reading from stdin is only supported with --prettify-only, --check or --diff, and a single input',
+                  color)
         exit(1)
 
-    processor = MipsProcessor(args)
-    processor.process()
+    if args.check or args.diff:
+        status = check(args, paths)
+        if status:
+            exit(status)
+        return
+
+    if args.watch:
+        if streaming:
+            parser.print_usage(stderr)
+            log_error('stdin cannot be watched', color)
+            exit(1)
+        if args.output and len(paths) > 1:
+            parser.print_usage(stderr)
+            log_error('an output filename cannot be used with multiple input files', color)
+            exit(1)
+        print('Watching {} files, press Ctrl+C to stop.'.format(len(paths)))
+        # The log of each file is captured, so decide whether to color it for the terminal now
+        args.color = 'always' if use_color(args.color, sys.stdout) else 'never'
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            print()
+        return
+
+    if len(paths) == 1:
+        args.file = paths[0]
+        processor = MipsProcessor(args)
+        processor.process()
+        return
+
+    if args.output:
+        parser.print_usage(stderr)
+        log_error('an output filename cannot be used with multiple input files', color)
+        exit(1)
+
+    args.color = 'always' if use_color(args.color, sys.stdout) else 'never'
+    file_prefix = LOG_FILE_PREFIX if args.color == 'always' else ANSI_PATTERN.sub('', LOG_FILE_PREFIX)
+
+    files_changed = 0
+    lines_changed = 0
+    errors = 0
+    for result in process_files(args, paths, args.jobs):
+        if text and (result.log or not args.quiet):
+            print(file_prefix + ' ' + result.path)
+        print(result.log, end='')
+        if result.error:
+            errors += 1
+            if text:
+                sys.stdout.flush()
+                log_error('{}: {}'.format(result.path, result.error), color)
+            else:
+                print(diagnostic_json(ERROR, result.path, result.error))
+        if result.lines_changed:
+            files_changed += 1
+            lines_changed += result.lines_changed
+
+    summary = '{} files processed, {} changed, {} lines reformatted, {} errors.'.format(
+        len(paths), files_changed, lines_changed, errors)
+    if not text:
+        print(diagnostic_json(INFO, None, summary))
+    elif not args.quiet:
+        print(summary)
+    if errors:
+        exit(1)
 
 
 if __name__ == '__main__':
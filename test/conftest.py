@@ -12,3 +12,10 @@ class Utils:
 @pytest.fixture
 def util():
     return Utils
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path_factory, monkeypatch):
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("MPPD_CACHE_DIR", str(path))
+    return path
@@ -1,3 +1,5 @@
+import json
+import re
 import pytest
 from sys import executable
 
@@ -9,9 +11,9 @@ SCRIPT_PATH = Path(__file__).parent / SCRIPT_RELATIVE_PATH
 
 @pytest.fixture
 def run_mips(testdir):
-    def do_run(*args):
+    def do_run(*args, **kwargs):
         args = [executable, SCRIPT_PATH] + list(args)
-        return testdir.run(*args)
+        return testdir.run(*args, **kwargs)
 
     return do_run
 
@@ -99,3 +101,165 @@ count_i_break:
         count_i_break:
         jr$ra#return;''')
     assert result == expected
+
+
+def test_prettify_stdin_to_stdout(run_mips):
+    run_result = run_mips("-", "-P", "-S", stdin=b"main:\n    li %x,1 # x = 1\n")
+    assert run_result.ret == 0
+    assert run_result.outlines == [
+        "main:",
+        "    li        %x, 1                                 # x = 1",
+    ]
+    assert "1 lines were reformatted." in run_result.errlines
+
+
+def test_stdin_requires_prettify_only(run_mips):
+    run_result = run_mips("-", stdin=b"main:\n")
+    assert run_result.ret == 1
+    assert run_result.outlines == []
+
+
+def test_multiple_files_in_parallel(tmpdir, run_mips):
+    sources = tmpdir.mkdir("labs")
+    for name in ("b.s", "a.s", "c.pretty.s"):
+        sources.join(name).write("main:\n    li %x,1\n")
+    sources.mkdir("nested").join("d.s").write("main:\n\tli\t\t%x, 1\n")
+
+    run_result = run_mips(sources, tmpdir.join("missing.s"), "-P", "-j", "2")
+    assert run_result.ret == 1
+    files = [line.split()[-1] for line in run_result.outlines if "[FILE]" in line]
+    assert files == [str(sources.join("a.s")), str(sources.join("b.s")),
+                     str(sources.join("nested", "d.s")), str(tmpdir.join("missing.s"))]
+    assert run_result.outlines[-1] == "4 files processed, 2 changed, 2 lines reformatted, 1 errors."
+    assert sources.join("a.pretty.s").check()
+    assert not sources.join("c.pretty.pretty.s").check()
+
+
+def test_functions_called_from_other_files(tmpdir, run_mips):
+    tmpdir.join("a.s").write("main:\n\tjal\thelper\n\tjr\t$ra\n")
+    tmpdir.join("b.s").write("helper:\n\tli\t%x, 1\n\tjr\t$ra\n")
+
+    run_result = run_mips(tmpdir.join("a.s"), tmpdir.join("b.s"))
+    assert run_result.ret == 0
+    assert "$t0, 1" in tmpdir.join("b.out.s").read()
+
+
+def test_output_with_multiple_files(tmpdir, run_mips):
+    tmpdir.join("a.s").write("main:\n")
+    tmpdir.join("b.s").write("main:\n")
+    run_result = run_mips(tmpdir.join("a.s"), tmpdir.join("b.s"), "-o", tmpdir.join("out.s"))
+    assert run_result.ret == 1
+
+
+def test_check_and_diff_do_not_write(tmpdir, run_mips):
+    sources = tmpdir.mkdir("labs")
+    sources.join("a.s").write("main:\n\tli\t\t%x, 1\n")
+    sources.join("b.s").write("main:\n\tli\t\t%x, 1\n    li %y,2\n")
+    sources.join("c.s").write("main:\n    li %z,3\n")
+
+    run_result = run_mips(sources, "--check")
+    assert run_result.ret == 1
+    assert run_result.outlines == [f"{sources.join('b.s')}:3: would be reformatted"]
+
+    run_result = run_mips(sources.join("a.s"), "--check")
+    assert run_result.ret == 0
+    assert run_result.outlines == ["1 files already formatted."]
+
+    run_result = run_mips(sources, "--diff")
+    assert run_result.ret == 0
+    assert "-    li %y,2" in run_result.outlines
+    assert "+\tli\t\t%y, 2" in run_result.outlines
+    assert "+\tli\t\t%z, 3" in run_result.outlines
+    assert sorted(x.basename for x in sources.listdir()) == ["a.s", "b.s", "c.s"]
+
+
+def test_unchanged_outputs_are_not_rewritten(tmpdir, run_mips):
+    source = tmpdir.join("main.s")
+    source.write("main:\n    li %x,1\n")
+    pretty, out = tmpdir.join("main.pretty.s"), tmpdir.join("main.out.s")
+
+    assert run_mips(source, "-p", "--no-cache").ret == 0
+    for path in (pretty, out):
+        path.setmtime(1000000000)
+    run_result = run_mips(source, "-p", "--no-cache")
+    assert run_result.ret == 0
+    assert f"Output '{out}' is unchanged" in run_result.outlines
+    assert pretty.mtime() == out.mtime() == 1000000000
+    assert not [x for x in tmpdir.listdir() if x.ext == ".tmp"]
+
+
+def test_replace_backs_up_only_on_change(tmpdir, run_mips):
+    source = tmpdir.join("main.s")
+    source.write("main:\n    li %x,1\n")
+
+    assert run_mips(source, "-r", "--prettify-only", "--no-cache").ret == 0
+    assert tmpdir.join("main.s.bak").read() == "main:\n    li %x,1\n"
+    tmpdir.join("main.s.bak").remove()
+
+    run_result = run_mips(source, "-r", "--prettify-only", "--no-cache")
+    assert run_result.ret == 0
+    assert f"'{source}' is already formatted" in run_result.outlines
+    assert not tmpdir.join("main.s.bak").exists()
+
+
+def test_timings_and_profile(tmpdir, run_mips):
+    source = tmpdir.join("main.s")
+    source.write("main:\n    li %x,1\n")
+
+    run_result = run_mips(source, "-p", "--timings", "--profile", tmpdir.join("mppd.prof"))
+    assert run_result.ret == 0
+    stages = [line.split()[0] for line in run_result.outlines[run_result.outlines.index("Timings:") + 1:]]
+    assert stages == ["cache", "prettify", "tokenize", "create_identifiers_mapping", "perform_replacements",
+                      "docs", "fix_comment_spacing", "write", "total", "Functions:", "main"]
+    assert tmpdir.join("mppd.prof").size() > 0
+
+
+def test_quiet_and_json_diagnostics(tmpdir, run_mips):
+    source = tmpdir.join("main.s")
+    source.write("main:\n    li %x,1\n    li %x.s, 2\n")
+
+    run_result = run_mips(source, "-p", "-q", "--no-cache")
+    assert run_result.ret == 0
+    assert run_result.outlines == ["Identifier %x declared before flag s"]
+
+    run_result = run_mips(source, "-p", "--diagnostics", "json", "--color", "always", "--no-cache")
+    records = [json.loads(line) for line in run_result.outlines]
+    assert {x["file"] for x in records} == {str(source)}
+    assert {"level": "warning", "file": str(source), "message": "Identifier %x declared before flag s"} in records
+    assert "\x1b" not in run_result.stdout.str()
+
+
+def test_errors_follow_color_option(tmpdir, run_mips):
+    missing = tmpdir.join("missing.s")
+    errors = run_mips(missing, "--check", "--color", "always").errlines
+    assert errors[-1].startswith(f"\x1b[31merror:\x1b[0m {missing}: ")
+    assert run_mips("--color", "always").errlines[-1] == "\x1b[31merror:\x1b[0m no input file specified"
+    assert run_mips("--color", "never").errlines[-1] == "error: no input file specified"
+
+
+def test_serve_formatting(run_mips):
+    def frame(message):
+        body = json.dumps(message).encode()
+        return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+    uri = "file:///main.s"
+    stdin = b"".join(frame(x) for x in [
+        {"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {}},
+        {"jsonrpc": "2.0", "method": "textDocument/didOpen",
+         "params": {"textDocument": {"uri": uri, "text": "main:\n    li %x,1\n"}}},
+        {"jsonrpc": "2.0", "id": 2, "method": "textDocument/formatting",
+         "params": {"textDocument": {"uri": uri}, "options": {"tabSize": 4, "insertSpaces": True}}},
+        {"jsonrpc": "2.0", "id": 3, "method": "shutdown"},
+        {"jsonrpc": "2.0", "method": "exit"},
+    ])
+    run_result = run_mips("--serve", stdin=stdin)
+    assert run_result.ret == 0
+
+    output = "".join(run_result.outlines)
+    responses = [json.loads(x) for x in re.split(r"Content-Length: \d+", output) if x]
+    assert [x["id"] for x in responses] == [1, 2, 3]
+    assert responses[0]["result"]["capabilities"]["documentFormattingProvider"]
+    assert responses[1]["result"] == [{
+        "range": {"start": {"line": 0, "character": 0}, "end": {"line": 2, "character": 0}},
+        "newText": "main:\n    li        %x, 1\n",
+    }]
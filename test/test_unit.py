@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from .. import mppd
@@ -15,6 +17,14 @@ def mips_main(monkeypatch):
     return do_main
 
 
+@pytest.fixture()
+def processor():
+    def make(*args):
+        return mppd.MipsProcessor(mppd.get_arg_parser().parse_args(list(args)))
+
+    return make
+
+
 @pytest.fixture()
 def assert_result(mips_main, tmpdir, monkeypatch):
     def do_test(mips_args, input_text: str, expected_text: str, filename: str = "test", use_main: bool = False,
@@ -190,3 +200,671 @@ def test_main_version_arg(mips_main, capfd):
     stdout, stderr = capfd.readouterr()
     assert stdout.startswith('v')
 
+
+
+def test_align_block_widens_columns_for_long_lines():
+    rows = [
+        (None, "li", "$t0, 1", "short"),
+        (None, "addiu", "$t1, $t1, 4", None),
+        (None, "syscall", "", "no operands"),
+        ("", None, None, "comment only"),
+    ]
+    assert mppd.align_block(rows) == [
+        "    li        $t0, 1" + " " * 32 + "# short",
+        "    addiu     $t1, $t1, 4",
+        "    syscall" + " " * 41 + "# no operands",
+        " " * 52 + "# comment only",
+    ]
+    long = (None, "lw", "$t0, " + "x" * 50 + "($sp)", "long")
+    texts = mppd.align_block(rows[:1] + [long] + [(None, "sltiu_wxyz", "$t0", None)])
+    assert [text.index("#") for text in texts if "#" in text] == [76, 76]
+    assert texts[0].startswith("    li         $t0")
+
+
+def test_instructions_without_a_tab_keep_the_mnemonic_column():
+    source = "main:\n\tli\t%x, 1\t# one\n\tsub $t0,$t1,$t2\t# c\n\tjr\t$ra\n"
+    assert mppd.preprocess_text(source).text.split("\n")[1:4] == [
+        "    li        $t0, 1" + " " * 32 + "# one",
+        "\tsub $t0,$t1,$t2" + " " * 36 + "# c",
+        "    jr        $ra",
+    ]
+
+
+def test_labels_keep_out_of_the_mnemonic_column():
+    source = "main:\n\tli\t%x, 1\t# one\nmain_loop_top:\tadd $t0, $t0, 1\t# inc\n\tjr\t$ra\n"
+    assert mppd.preprocess_text(source).text.split("\n")[1:4] == [
+        "    li        $t0, 1" + " " * 32 + "# one",
+        "main_loop_top:\tadd $t0, $t0, 1" + " " * 22 + "# inc",
+        "    jr        $ra",
+    ]
+
+
+def test_prettify_spaces_a_block_at_a_time():
+    source = "main:\n\taddiu $t1,$t1,4 # step\n\tli $t0, 1\n\n\tli $t2, 2\n"
+    result = mppd.prettify_text(source, mppd.Options(space=True))
+    assert result.text.split("\n")[1:5] == [
+        "    addiu     $t1, $t1, 4" + " " * 27 + "# step",
+        "    li        $t0, 1",
+        "",
+        "    li        $t2, 2",
+    ]
+    changed = list(mppd.unformatted_lines(source.splitlines(True), mppd.Options(space=True)))
+    assert [(number, line) for number, line, _ in changed] == [(2, "\taddiu $t1,$t1,4 # step\n"),
+                                                             (3, "\tli $t0, 1\n"), (5, "\tli $t2, 2\n")]
+
+
+def test_tokenize_line():
+    line = mppd.tokenize_line("loop:\tbge\t%i, %max.s, end\t# %i < %max", 4)
+    assert line.num == 4
+    assert line.label == "loop"
+    assert line.mnemonic == "bge"
+    assert line.operands == ("%i,", "%max.s,", "end")
+    assert line.comment == " %i < %max"
+    assert [(name, flag) for _, _, name, flag in line.identifiers] == [("%i", None), ("%max", "s")]
+    start, end, _, _ = line.identifiers[1]
+    assert line.text[start:end] == "%max.s"
+    assert not line.is_indented
+
+    blank = mppd.tokenize_line("")
+    assert blank.label is None and blank.mnemonic is None and blank.comment is None
+    assert mppd.tokenize_line("    li $t0, 1").is_indented
+
+
+def test_identifiers_mapping_order_and_flags(processor):
+    text = """count:
+    li      %max.s, 10      # %ignored in comment
+    li      %i, 0
+    bge     %i, %max, end   # %max
+    add     %j, %i, %i
+"""
+    identifiers, flags = processor().create_identifiers_mapping(text)
+    assert identifiers == {"%max": "$s0", "%i": "$t0", "%j": "$t1"}
+    assert flags == {"%max.s": "%max"}
+
+
+def test_identifiers_mapping_spills_into_saved_registers(processor):
+    text = "\n".join("    li %v{}, 0".format(i) for i in range(12))
+    identifiers, _ = processor().create_identifiers_mapping(text)
+    assert identifiers["%v9"] == "$t9"
+    assert identifiers["%v10"] == "$s0"
+    assert identifiers["%v11"] == "$s1"
+
+
+def test_identifiers_mapping_spills_onto_stack(processor, capsys):
+    # The value used in the loop is kept in a register, the last of the least used ones go on the stack
+    text = "\n".join(["main:"] + [f"    li %v{i}, {i}" for i in range(22)] + [
+        "loop:", "    add %v21, %v21, %v0", "    bnez %v21, loop", "    jr $ra"])
+    p = processor()
+    identifiers, _ = p.create_identifiers_mapping(text)
+    assert identifiers["%v21"].startswith("$")
+    assert {k: v for k, v in identifiers.items() if not v.startswith("$")} == \
+        {"%v18": "0($sp)", "%v19": "4($sp)", "%v20": "8($sp)"}
+    # The last temporary register is kept free for loading values from the stack
+    assert "$t9" not in identifiers.values()
+    p.flush()
+    assert "Identifier %v20 exceeded available registers, stored on the stack" in capsys.readouterr().out
+
+
+def test_spilled_identifiers_are_loaded_and_stored():
+    source = "main:\n\taddi\t$sp, $sp, -4\n" + "".join(f"\tli\t%v{i}.s, {i}\n" for i in range(11)) + \
+        "loop:\n" + "".join(f"\tbnez\t%v{i}, loop\n" for i in range(10)) + \
+        "\tadd\t%v10, %v10, %v10\n\taddi\t$sp, $sp, 4\n\tjr\t$ra\n"
+    result = mppd.preprocess_text(source, mppd.Options(docs=True))
+    assert result.identifiers["main"]["%v10"] == "0($sp)"
+
+    lines = [" ".join(line.split()) for line in result.text.split("\n") if line and not line.startswith("#")]
+    assert lines[:3] == ["main:", "addi $sp, $sp, -4", "addi $sp, $sp, -4"]
+    assert lines[13:15] == ["li $t9, 10", "sw $t9, 4($sp) # %v10"]
+    assert lines[-6:] == [
+        "lw $t9, 4($sp) # %v10",
+        "add $t9, $t9, $t9",
+        "sw $t9, 4($sp) # %v10",
+        "addi $sp, $sp, 4",
+        "addi $sp, $sp, 4",
+        "jr $ra",
+    ]
+    assert "Spills:     4 bytes" in result.docs["main"]
+    assert "Identifier %v10 exceeded available $s registers, stored on the stack" in "\n".join(result.diagnostics)
+
+
+def test_spilled_identifiers_keep_blocks_of_repeated_labels():
+    source = "main:\n1:\n\tli\t%a, 1\n\tbeqz\t$t0, 1f\n1:\n\taddi\t%a, %a, 2\n\tjr\t$ra"
+    lines = list(mppd.tokenize(source.split("\n")))
+    assert list(mppd.basic_blocks(lines)) == ["main", "1", "1.1"]
+    spilled = mppd.Preprocessor.spill_identifiers(lines, {"%a": "0($sp)"})
+    assert [line for line in spilled if "lw" not in line and "sw" not in line and "$sp, $sp" not in line] == \
+        ["main:", "1:", "\tli\t$t9, 1", "\tbeqz\t$t0, 1f", "1:", "\taddi\t$t9, $t9, 2", "\tjr\t$ra"]
+
+
+def test_replace_identifiers_is_token_aware():
+    identifiers = {"%i": "$t0", "%idx": "$t1", "%max": "$s0"}
+    lines = mppd.tokenize(["    add %idx, %i, %max.s    # %i stays", "    lw %i, 0(%idx)", "    jr %unknown"])
+    assert [mppd.MipsProcessor.replace_identifiers(line, identifiers) for line in lines] == \
+        ["    add $t1, $t0, $s0    # %i stays", "    lw $t0, 0($t1)", "    jr %unknown"]
+
+
+def test_replace_identifiers_many_placeholders():
+    identifiers = {"%v{}".format(i): "$r{}".format(i) for i in range(300)}
+    text = "\n".join("    add %v{}, %v{}, %v{}".format(i, (i * 7) % 300, (i * 13) % 300) for i in range(300))
+    expected = "\n".join("    add $r{}, $r{}, $r{}".format(i, (i * 7) % 300, (i * 13) % 300) for i in range(300))
+    lines = mppd.tokenize(text.split("\n"))
+    assert "\n".join(mppd.MipsProcessor.replace_identifiers(line, identifiers) for line in lines) == expected
+
+
+def test_register_index_separates_defs_and_uses():
+    lines = list(mppd.tokenize([
+        "count:\tlw\t%n, 0($t10)\t# $t2 is only mentioned",
+        "\tadd\t$t1, %n, $a0",
+        "\tsw\t$t1, 4($sp)",
+        "\tbeq\t$t1, $zero, count",
+        "\tjal\tprint",
+    ]))
+    index = mppd.RegisterIndex.build(lines, {"%n": "$t0"})
+    assert index.defs == {"$t0": [1], "$t1": [2], "$ra": [5]}
+    assert index.uses == {"$t10": [1], "$t0": [2], "$a0": [2], "$t1": [3, 4], "$sp": [3], "$zero": [4]}
+
+
+@pytest.mark.parametrize("mnemonic, operand_count, writes", [
+    ("addiu", 3, True), ("lw", 2, True), ("li", 2, True), ("cvt.w.d", 2, True), ("div", 3, True),
+    ("div", 2, False), ("div.s", 3, True), ("mtc1", 2, False), ("mtc0", 2, False), ("sc", 2, False),
+    ("teq", 2, False), ("c.eq.s", 2, False), ("sw", 2, False), ("bnez", 2, False), ("syscall", 0, False),
+])
+def test_writes_first_operand(mnemonic, operand_count, writes):
+    assert mppd.writes_first_operand(mnemonic, operand_count) is writes
+
+
+def test_clobbers_are_written_registers(processor):
+    text = "main:\n\tmove\t$a1, $t1\n\tsw\t$t2, 0($sp)\t# $t3\n\tjr\t$ra\n"
+    p = processor("-d", "-")
+    p.preprocess_lines(list(mppd.tokenize(text.split("\n"))))
+    docs = "\n".join(p.docs["main"])
+    assert "Frame:      $ra, $sp" in docs
+    assert "Uses:       $a1, $t1, $t2" in docs
+    assert "Clobbers:   $a1" in docs.split("\n")
+
+
+CONTROL_FLOW_SOURCE = """main:
+\tli\t%i, 0
+loop:
+\tbge\t%i, 10, done
+\taddi\t%i, %i, 1
+\tj\tloop
+done:
+\tjal\tprint
+\tjr\t$ra
+print:
+\tjr\t$ra
+"""
+
+
+def test_label_index():
+    lines = list(mppd.tokenize(CONTROL_FLOW_SOURCE.split("\n")))
+    index = mppd.LabelIndex(lines, ["main", "print"])
+    assert list(index) == ["main", "loop", "done", "print"]
+    assert index["loop"] == mppd.Label("loop", 2, "main", ("done", "loop"))
+    assert index["main"].successors == ("loop",)
+    assert index["done"].successors == ()
+    assert index.functions == {"main": ["main", "loop", "done"], "print": ["print"]}
+
+
+def test_control_flow_documentation():
+    result = mppd.preprocess_text(CONTROL_FLOW_SOURCE, mppd.Options(extra_functions=["print"], cfg="text"))
+    assert result.docs["main"][-5:] == [
+        "Control flow:",
+        "      - main -> loop",
+        "      - loop -> done, loop.1",
+        "      - loop.1 -> loop",
+        "      - done",
+    ]
+
+
+CALL_SOURCE = """main:
+\tjal\tf
+\tjal\tleaf
+\tjr\t$ra
+f:
+\tli\t$t1, 1
+\tjal\tg
+\tjr\t$ra
+g:
+\tli\t$a0, 2
+\tjal\tf
+\tjal\tleaf
+\tjr\t$ra
+leaf:
+\tli\t$t2, 3
+\tjalr\t$t2
+\tjr\t$ra
+"""
+
+
+def test_call_graph():
+    graph = mppd.CallGraph(mppd.tokenize(CALL_SOURCE.split("\n")), ["main"])
+    assert graph.calls == {"main": ["f", "leaf"], "f": ["g"], "g": ["f", "leaf"], "leaf": []}
+    assert graph.components() == [["leaf"], ["g", "f"], ["main"]]
+    clobbers = graph.compose({"f": {"$t1"}, "g": {"$a0"}, "leaf": {"$t2"}})
+    assert clobbers["main"] == clobbers["f"] == clobbers["g"] == {"$a0", "$t1", "$t2"}
+    assert clobbers["leaf"] == {"$t2"}
+
+
+def test_functions_are_detected_and_clobber_transitively():
+    result = mppd.preprocess_text(CALL_SOURCE, mppd.Options(docs=True))
+    assert list(result.docs) == ["main", "f", "g", "leaf"]
+    assert "Clobbers:   $a0, $t1, $t2" in result.docs["main"]
+    assert "Clobbers:   $t2" in result.docs["leaf"]
+    assert "# Clobbers:   $a0, $t1, $t2" in result.text.split("\n")
+
+
+OPTIMIZE_SOURCE = """main:
+\tli\t%x, 1
+\tli\t%x, 2
+\tmove\t%y, %y\t# copy
+\tsw\t%x, 0($sp)
+\tlw\t%x, 0($sp)
+\tsw\t%x, 4($sp)
+\tlw\t%z, 4($sp)
+\tj\tnext
+next:
+\tjr\t$ra
+"""
+
+
+def test_peephole_rewrites_are_reported():
+    result = mppd.preprocess_text(OPTIMIZE_SOURCE, mppd.Options(optimize=True))
+    assert [x for x in result.diagnostics if x.startswith("Line")] == [
+        "Line 2: 'li $t0, 1' is overwritten by the next instruction",
+        "Line 4: 'move $t1, $t1' has no effect",
+        "Line 6: 'lw $t0, 0($sp)' loads the value just stored",
+        "Line 8: 'lw $t2, 4($sp)' replaced by 'move $t2, $t0'",
+        "Line 9: 'j next' jumps to the next instruction",
+    ]
+    assert [line.split() for line in result.text.splitlines()] == [
+        ["main:"], ["li", "$t0,", "2"], ["#", "copy"], ["sw", "$t0,", "0($sp)"], ["sw", "$t0,", "4($sp)"],
+        ["move", "$t2,", "$t0"], ["next:"], ["jr", "$ra"],
+    ]
+
+
+def test_peephole_keeps_labels_and_needed_instructions():
+    source = "main:\n\tsw\t$t0, 0($sp)\nagain:\tlw\t$t0, 0($sp)\n\tli\t$v0, 10\n\tsyscall\n" \
+             "\tli\t$t1, 1\n\taddi\t$t1, $t1, 1\nskip:\tj\tend\nend:\n\tjr\t$ra\n"
+    lines, rewrites = mppd.peephole(mppd.tokenize(source.split("\n")))
+    assert rewrites == [(8, "'j end' jumps to the next instruction")]
+    assert lines[7] == "skip:"
+    assert lines[:7] == source.split("\n")[:7]
+
+    # Loads of spilled identifiers are numbered after the line they are loaded for
+    lines = list(mppd.tokenize(["main:", "\tli\t%a, 1", "\taddi\t%a, %a, 2"]))
+    spilled = mppd.Preprocessor.spill_identifiers(lines, {"%a": "0($sp)"}, numbered=True)
+    _, rewrites = mppd.peephole(mppd.tokenize_line(text, num) for num, text in spilled)
+    assert rewrites == [(3, "'lw $t9, 0($sp)' loads the value just stored")]
+
+
+def test_peephole_keeps_instructions_which_read_or_reach_data():
+    # Moving to a coprocessor and storing conditionally read the constant, and the jumps skip over data
+    source = "main:\n\tli\t$t0, 1\n\tmtc1\t$t0, $f0\n\tli\t$t1, 7\n\tsc\t$t1, 0($a0)\n" \
+             "\tj\tskip\ntable:\t.word 1,2,3\nskip:\n\tb\tover\n\t.word 0x0000000d\nover:\n\tjr\t$ra\n"
+    lines, rewrites = mppd.peephole(mppd.tokenize(source.split("\n")))
+    assert rewrites == []
+    assert lines == source.split("\n")
+
+    source = "main:\n\tsw\t$t0, 0($sp)\n\t.align 2\n\tlw\t$t0, 0($sp)\n\tli\t$t1, 1\n\t.word 0\n\tli\t$t1, 2\n"
+    assert mppd.peephole(mppd.tokenize(source.split("\n")))[1] == []
+
+
+def test_static_cost_weights_loops():
+    source = """main:
+\tli\t$t0, 0
+outer:
+\tli\t$t1, 0
+inner:
+\tlw\t$t2, 0($a0)
+\tmul\t$t2, $t2, $t2
+\taddi\t$t1, $t1, 1
+\tblt\t$t1, 4, inner
+\taddi\t$t0, $t0, 1
+\tblt\t$t0, 4, outer
+\tli\t$v0, 10
+\tsyscall
+"""
+    cost = mppd.static_cost(list(mppd.tokenize(source.split("\n"))))
+    assert dict(cost.classes) == {"alu": 5, "load/store": 1, "branch": 2, "mult/div": 1, "syscall": 1}
+    assert cost.instructions == 10
+    assert cost.loops == [("outer", 1, 7), ("inner", 2, 4)]
+    assert cost.cycles == 1 + 10 * (1 + 1 + 2) + 100 * (2 + 10 + 1 + 2) + 1 + 50
+
+
+def test_cost_documentation_and_report():
+    source = "main:\n\tjal\tf\n\tjr\t$ra\nf:\n\tli\t%i, 0\nloop:\n\taddi\t%i, %i, 1\n\tblt\t%i, 8, loop\n\tjr\t$ra\n"
+    cache = mppd.ResultCache(persistent=False)
+    result = mppd.preprocess_text(source, mppd.Options(cost=True), cache)
+    assert result.docs["f"] == [
+        "",
+        "Cost:",
+        "      - 4 instructions: 2 alu, 2 branch",
+        "      - 33 cycles, with each loop run 10 times",
+        "      - loop loop: 2 instructions, depth 1",
+    ]
+    report = [x for x in result.diagnostics if x.startswith("Estimated cost:")][0].split("\n")
+    assert [line.split()[0] for line in report[1:] if line] == ["f", "main"]
+    # Costs of cached functions are reported as well
+    assert mppd.preprocess_text(source, mppd.Options(cost=True), cache) == result
+
+
+def test_liveness_allocation_reuses_registers():
+    # Twelve short-lived values, which would otherwise spill into saved registers
+    source = "main:\n" + "".join(f"\tli\t%v{i}, {i}\n\tsw\t%v{i}, {4 * i}($sp)\n" for i in range(12))
+    result = mppd.preprocess_text(source, mppd.Options(alloc="liveness", locals=True))
+    assert set(result.identifiers["main"].values()) == {"$t0"}
+    assert "$s0" not in result.text
+    assert result.docs["main"][-1] == "      - '" + "', '".join(f"v{i}" for i in range(12)) + "' in $t0"
+
+
+def test_liveness_allocation_keeps_loop_values_apart():
+    source = """main:
+\tli\t%sum, 0
+\tli\t%i, 10
+loop:
+\tli\t%step, 1
+\tadd\t%sum, %sum, %i
+\tsub\t%i, %i, %step
+\tbnez\t%i, loop
+\tli\t%after, 2
+\tadd\t%sum, %sum, %after
+\tli\t%kept.s, 0
+"""
+    identifiers = mppd.preprocess_text(source, mppd.Options(alloc="liveness")).identifiers["main"]
+    assert identifiers == {"%sum": "$t0", "%i": "$t1", "%step": "$t2", "%after": "$t1", "%kept": "$s0"}
+
+
+def test_liveness_allocation_follows_jumps_through_registers():
+    source = "main:\n\tli\t%a, 1\n\tla\t%t, target\n\tjr\t%t\ntarget:\n\tmove\t$v0, %a\n\tjr\t$ra\n"
+    lines = list(mppd.tokenize(source.split("\n")))
+    assert [block.successors for block in mppd.basic_blocks(lines).values()] == [("main", "target"), ()]
+    identifiers = mppd.preprocess_text(source, mppd.Options(alloc="liveness")).identifiers["main"]
+    assert identifiers == {"%a": "$t0", "%t": "$t1"}
+
+
+def test_output_keeps_line_structure(mips_main, tmpdir):
+    in_path = tmpdir.join("main.s")
+    out_path = tmpdir.join("main.out.s")
+    in_path.write("main:\n    li %x, 1\n")
+    mips_main([str(in_path), "-o", str(out_path), "-p", "-S"])
+    assert tmpdir.join("main.pretty.s").read() == "main:\n    li        %x, 1\n"
+    assert out_path.read() == "main:\n    li        $t0, 1\n"
+
+
+@pytest.mark.parametrize("space", [False, True])
+def test_prettify_in_chunks_matches_serial(tmpdir, monkeypatch, capsys, space):
+    monkeypatch.setattr(mppd, "PRETTIFY_CHUNK_SIZE", 64)
+    in_path = tmpdir.join("main.s")
+    in_path.write("".join(f"f{i}:\n\tli %x,{i}\n\taddiu\t$t0,$t0,1 # {i}\n\n" for i in range(40)))
+    args = [str(in_path), "-P", "--no-cache"] + (["-S"] if space else [])
+
+    outputs = []
+    for jobs in ("1", "3"):
+        processor = mppd.MipsProcessor(mppd.get_arg_parser().parse_args(args + ["-j", jobs]))
+        processor.process()
+        messages = [x for x in capsys.readouterr().out.split("\n") if x.startswith("Line")]
+        outputs.append((tmpdir.join("main.pretty.s").read(), messages, processor.lines_changed))
+    assert outputs[0] == outputs[1]
+    assert outputs[1][1][-1].startswith("Line 159: ")
+    assert processor.prettify_chunks(str(in_path), 3) == outputs[1][0]
+    assert outputs[1][2] == 80
+
+
+def test_prettify_lines_is_lazy(processor):
+    def source():
+        yield "main:\n"
+        yield "    li $t0,1\n"
+        raise AssertionError("read past the requested lines")
+
+    mips = processor("-", "-P")
+    prettifier = mips.prettify_lines(source())
+    assert next(prettifier) == "main:"
+    assert next(prettifier) == "\tli\t\t$t0, 1"
+    assert mips.lines_changed == 1
+
+
+def test_stream_log_is_written_in_batches(processor, monkeypatch):
+    monkeypatch.setattr(mppd, "LOG_BATCH_SIZE", 4)
+    flush = mppd.MipsProcessor.flush
+    lines_read = []
+    flushed = []
+
+    def spy(self):
+        flushed.append(len(lines_read))
+        flush(self)
+
+    def source():
+        for i in range(10):
+            lines_read.append(i)
+            yield "    li $t0,{}\n".format(i)
+
+    monkeypatch.setattr(mppd.MipsProcessor, "flush", spy)
+    mips = processor("-", "-P")
+    for _ in mips.prettify_lines(source()):
+        pass
+    # Two messages for each line changed, written four at a time
+    assert flushed == [2, 4, 6, 8, 10]
+
+
+def test_cache_reuses_unchanged_results(mips_main, tmpdir, monkeypatch, capfd):
+    in_path = tmpdir.join("count.s")
+    out_path = tmpdir.join("count.out.s")
+    in_path.write("count:\n    li %max, 1\n    li %max.s, 10\n")
+    args = [str(in_path), "-o", str(out_path), "-f", "count", "-p"]
+    mips_main(args)
+    expected = out_path.read()
+    first_log, _ = capfd.readouterr()
+
+    out_path.remove()
+    tmpdir.join("count.pretty.s").remove()
+    monkeypatch.setattr(mppd.MipsProcessor, "process_uncached", lambda self: pytest.fail("cache was not used"))
+    mips_main(args)
+    assert out_path.read() == expected
+    assert tmpdir.join("count.pretty.s").check()
+    assert capfd.readouterr()[0] == first_log
+
+    with pytest.raises(pytest.fail.Exception):
+        mips_main(args + ["--no-cache"])
+    in_path.write("count:\n    li %max, 2\n")
+    with pytest.raises(pytest.fail.Exception):
+        mips_main(args)
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = mppd.ResultCache(str(tmpdir), max_bytes=1000)
+    for age, key in enumerate(("c", "b", "a")):
+        cache.put(key, {"data": "x" * 30})
+        os.utime(cache.path(key), (age, age))
+    assert cache.get("c") is not None
+
+    # Evicted down to three quarters of the limit
+    cache.max_bytes = 120
+    cache.put("d", {"data": "x" * 30})
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.get("d") is not None
+
+
+def test_cache_counts_its_size_as_it_grows(tmpdir, monkeypatch):
+    cache = mppd.ResultCache(str(tmpdir), max_bytes=900)
+    cache.put("a", {"data": "x" * 30})
+    monkeypatch.setattr(mppd.ResultCache, "scan", lambda self: pytest.fail("cache was scanned again"))
+    for key in "bcdefghijklmnopqrstu":
+        cache.put(key, {"data": "x" * 30})
+    assert mppd.ResultCache.directory_bytes[str(tmpdir)] == 21 * 42
+
+    monkeypatch.undo()
+    cache.put("v", {"data": "x" * 30})
+    assert len(tmpdir.listdir()) * 42 == mppd.ResultCache.directory_bytes[str(tmpdir)] == 16 * 42
+
+
+def test_cache_skips_entries_larger_than_it(processor, tmpdir, cache_dir):
+    cache = mppd.ResultCache(str(tmpdir), max_bytes=100)
+    cache.put("a", {"data": "x" * 200})
+    assert cache.get("a") is None
+    assert mppd.ResultCache.recall("a") is None
+
+    log = mppd.LogRecord(10)
+    log.add(mppd.INFO, "12345")
+    assert log == [[mppd.INFO, "12345"]]
+    log.add(mppd.INFO, "123456")
+    log.add(mppd.INFO, "1")
+    assert log.overflowed and log == []
+
+    # Neither the input nor the log of prettifying it fit
+    in_path = tmpdir.join("count.s")
+    for size in (10, 60):
+        in_path.write("count:\n    li %max.s, 10\n")
+        p = processor(str(in_path), "-p")
+        p.cache.max_bytes = size
+        p.process()
+        assert list(cache_dir.iterdir()) == []
+
+
+def test_only_changed_functions_are_processed_again(mips_main, tmpdir, monkeypatch, cache_dir):
+    in_path = tmpdir.join("funcs.s")
+    out_path = tmpdir.join("funcs.out.s")
+    source = "{}:\n    li %x, {}\n    jr $ra\n"
+    functions = ["f{}".format(i) for i in range(5)]
+    args = [str(in_path), "-o", str(out_path), "-d", "-l", "-s"]
+    for name in functions:
+        args += ["-f", name]
+
+    in_path.write("".join(source.format(name, 1) for name in functions))
+    mips_main(args)
+    # One entry for the file, and one for its functions
+    assert len(list(cache_dir.iterdir())) == 2
+    monkeypatch.setattr(mppd.ResultCache, "memory", mppd.OrderedDict())
+
+    processed = []
+    process_function = mppd.MipsProcessor.process_function
+
+    def spy(self, name, *rest):
+        processed.append(name)
+        return process_function(self, name, *rest)
+
+    monkeypatch.setattr(mppd.MipsProcessor, "process_function", spy)
+    in_path.write("".join(source.format(name, 2 if name == "f3" else 1) for name in functions))
+    mips_main(args)
+    assert processed == ["f3"]
+
+    expected = out_path.read()
+    mips_main(args + ["--no-cache"])
+    assert out_path.read() == expected
+    assert processed == ["f3"] + functions
+
+
+def test_calls_only_change_the_files_of_their_callees(tmpdir):
+    tmpdir.join("a.s").write("main:\n\tjal\thelper\n\tjr\t$ra\n")
+    tmpdir.join("b.s").write("helper:\n\tli\t%x, 1\n\tjr\t$ra\nother:\n\tli\t%y, 2\n\tjr\t$ra\n")
+    tmpdir.join("c.s").write("main:\n\tli\t%z, 3\n\tjr\t$ra\n")
+    args = mppd.get_arg_parser().parse_args([str(tmpdir)])
+    paths = mppd.expand_inputs([str(tmpdir)])
+    assert [x.functions_processed for x in mppd.process_files(args, paths)] == [1, 1, 1]
+
+    # The new callee ends helper, which is processed again along with it, while c.s is left alone
+    tmpdir.join("a.s").write("main:\n\tjal\thelper\n\tjal\tother\n\tjr\t$ra\n")
+    assert [x.functions_processed for x in mppd.process_files(args, paths)] == [1, 2, 0]
+    assert "$t0, 2" in tmpdir.join("b.out.s").read()
+
+
+def test_clobbers_are_composed_across_files(tmpdir):
+    tmpdir.join("a.s").write("main:\n\tjal\thelper\n\tli\t$t1, 2\n\tjr\t$ra\n")
+    tmpdir.join("b.s").write("helper:\n\tjal\tleaf\n\tjal\tmain\n\tli\t%x, 1\n\tjr\t$ra\n")
+    tmpdir.join("c.s").write("leaf:\n\tli\t$a2, 3\n\tjr\t$ra\n")
+    calls = [mppd.file_calls(str(tmpdir.join(name))) for name in ("a.s", "b.s", "c.s")]
+    # a.s and b.s call each other, so a.s is processed first, without the clobbers of helper
+    assert mppd.call_waves(calls) == [[2], [0], [1]]
+    graph = mppd.CallGraph(mppd.tokenize(tmpdir.join("b.s").read().split("\n")), ["helper"])
+    assert graph.external == {"helper": ["leaf", "main"]}
+
+    args = mppd.get_arg_parser().parse_args([str(tmpdir), "-d", "--no-cache"])
+    results = list(mppd.process_files(args, mppd.expand_inputs([str(tmpdir)])))
+    assert [x.clobbers for x in results] == [{"main": ["$t1"]}, {"helper": ["$a2", "$t0", "$t1"]}, {"leaf": ["$a2"]}]
+    assert "# Clobbers:   $a2, $t0, $t1" in tmpdir.join("b.out.s").read()
+
+    tmpdir.join("b.s").write("helper:\n\tjal\tleaf\n\tli\t%x, 1\n\tjr\t$ra\n")
+    results = list(mppd.process_files(args, mppd.expand_inputs([str(tmpdir)])))
+    assert results[0].clobbers == {"main": ["$a2", "$t0", "$t1"]}
+    assert "# Clobbers:   $a2, $t0, $t1" in tmpdir.join("a.out.s").read()
+
+
+def test_watcher_debounces_changes(tmpdir):
+    a = tmpdir.join("a.s")
+    b = tmpdir.join("b.s")
+    a.write("main:\n")
+    b.write("main:\n")
+    watcher = mppd.Watcher([str(tmpdir)], interval=1, debounce=2)
+    assert sorted(watcher.state) == [str(a), str(b)]
+    assert watcher.poll() == []
+
+    saves = [lambda: a.write("main:\n    li $t0, 1\n"), lambda: None, lambda: b.write("main:\n\n"),
+             lambda: None, lambda: None, lambda: pytest.fail("waited after the debounce period")]
+    assert sorted(watcher.wait(lambda _: saves.pop(0)())) == [str(a), str(b)]
+
+
+def test_watch_processes_saved_files(tmpdir, capsys):
+    in_path = tmpdir.join("main.s")
+    in_path.write("main:\n    li %x, 1\n")
+    args = mppd.get_arg_parser().parse_args([str(in_path), "--watch"])
+
+    def save(_):
+        if in_path.read() != "main:\n    li %x, 20\n":
+            in_path.write("main:\n    li %x, 20\n")
+
+    mppd.watch(args, sleep=save, iterations=2)
+    first, second = capsys.readouterr().out.splitlines()
+    assert "1 functions processed" in first
+    assert second.endswith("1 functions processed, {} +1 -1".format(tmpdir.join("main.out.s")))
+    assert tmpdir.join("main.out.s").read() == "main:\n    li $t0, 20\n"
+
+
+def test_prettify_text():
+    result = mppd.prettify_text("main:\n    li $t0,1 # one\n", mppd.Options(space=True))
+    assert result.text == "main:\n    li        $t0, 1                                # one\n"
+    assert any("Line 2" in message for message in result.diagnostics)
+
+
+def test_preprocess_text(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    options = mppd.Options(prettify=True, extra_functions=["count"], docs=True, locals=True)
+    with pytest.raises(AttributeError):
+        options.docs = False
+
+    cache = mppd.ResultCache(persistent=False)
+    source = "count:\n    li %max.s, 10\n    li %i, 0\n"
+    result = mppd.preprocess_text(source, options, cache)
+    assert result.identifiers == {"count": {"%max": "$s0", "%i": "$t0"}}
+    assert result.docs["count"][:3] == ["Frame:      $s0", "Uses:       $s0, $t0", "Clobbers:   $t0"]
+    assert result.text.endswith("count:\n    li        $s0, 10\n    li        $t0, 0\n")
+    assert "Identifier '%max' has flag 's'" in result.diagnostics
+    assert mppd.preprocess_text(source, options, cache) == result
+    assert tmpdir.listdir() == []
+
+
+def test_server_requests():
+    server = mppd.Server(None, None)
+    source = "main:\n    li %x,1\n"
+    response = server.handle({"jsonrpc": "2.0", "id": 1, "method": "mppd/preprocess",
+                              "params": {"text": source, "options": {"locals": True}}})
+    assert response["result"]["text"] == "main:\n    li $t0,1\n"
+    assert response["result"]["docs"]["main"][-1] == "      - 'x' in $t0"
+    assert server.handle({"jsonrpc": "2.0", "method": "mppd/prettify", "params": {}}) is None
+
+    response = server.handle({"jsonrpc": "2.0", "id": 2, "method": "mppd/docs", "params": {"uri": "file:///a.s"}})
+    assert response["error"]["code"] == -32602
+    response = server.handle({"jsonrpc": "2.0", "id": 3, "method": "mppd/unknown"})
+    assert response["error"]["code"] == -32601
+
+
+def test_timing_hooks():
+    timings = []
+    mppd.preprocess_text("main:\n    li %x,1\nf:\n    li %y,2\n", mppd.Options(extra_functions=["f"]),
+                         hooks=[timings.append])
+    functions = [(x.function, x.lines) for x in timings if x.stage == "function"]
+    assert functions == [("main", 2), ("f", 2)]
+    assert timings[-1].stage == "fix_comment_spacing"
+    assert all(x.seconds >= 0 for x in timings)